@@ -20,7 +20,7 @@ setup(
     install_requires=[
         'numpy',
         'pandas',
-        'scipy>=1.6.0',
+        'scipy>=1.7.0',
         'PyYaml'
     ]
 )
\ No newline at end of file
@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+from tunetools import config, core
+from tunetools.search_space import GridSearchSpace
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # a fresh working directory for .tune
+    monkeypatch.chdir(tmp_path)
+    # the journal keeps the path of the first study it writes to
+    monkeypatch.setattr(config, "_journal_sample", 0)
+    return tmp_path
+
+
+@pytest.fixture
+def study(workdir):
+    # a .tune/tune.db with 12 pending tasks, one per value of `a`
+    core.prepare(num_sample=1, parameters=[GridSearchSpace("a", 0, list(range(12)))])
+    return os.path.abspath(os.path.join(".tune", "tune.db"))
@@ -0,0 +1,90 @@
+import shutil
+
+import pytest
+
+from tunetools import core, db_utils
+from tunetools.result_cache import ResultCache
+from tunetools.search_space import GridSearchSpace
+
+PARAMETERS = [GridSearchSpace("a", 0, list(range(6)))]
+
+
+def _counts(path=".tune/tune.db"):
+    conn = db_utils.connect(path)
+    counts = dict(db_utils.execute_sql(conn, "SELECT STATUS, COUNT(*) FROM RESULT GROUP BY STATUS"))
+    conn.close()
+    return counts
+
+
+def test_run_with_lease(study):
+    def main(a):
+        return {"r": a}
+
+    core.run(main, parameters=[GridSearchSpace("a", 0, list(range(12)))], lease=5)
+    assert _counts() == {"TERMINATED": 12}
+
+
+def test_run_retries_a_trial_without_result(study):
+    calls = []
+
+    def main(a):
+        calls.append(a)
+        return None if calls.count(a) == 1 and a == 3 else {"r": a}
+
+    core.run(main, parameters=[GridSearchSpace("a", 0, list(range(12)))])
+    assert _counts() == {"TERMINATED": 12}
+    assert calls.count(3) == 2
+
+
+def test_run_async(study):
+    import asyncio
+
+    async def main(a):
+        await asyncio.sleep(0.01)
+        return {"r": a}
+
+    core.run(main, parameters=[GridSearchSpace("a", 0, list(range(12)))], concurrency=4, lease=2)
+    assert _counts() == {"TERMINATED": 12}
+
+
+def test_concurrency_needs_async_main(study):
+    with pytest.raises(ValueError):
+        core.run(lambda a: {"r": a}, parameters=[GridSearchSpace("a", 0, list(range(12)))],
+                 concurrency=2)
+
+
+def test_result_cache_across_recreated_studies(workdir):
+    calls = []
+
+    def main(a):
+        calls.append(a)
+        return {"r": a}
+
+    def run(source):
+        shutil.rmtree(".tune", ignore_errors=True)
+        cache = ResultCache(str(workdir / "cache.db"), source)
+        core.run(main, parameters=PARAMETERS, result_cache=cache)
+
+    run("v1")
+    run("v1")
+    assert len(calls) == 6
+    # a new source, in a study recreated at the same path, with the same task IDs
+    run("v2")
+    run("v2")
+    assert len(calls) == 12
+    assert _counts() == {"TERMINATED": 6}
+
+
+def test_report_converts_numbers(workdir):
+    import numpy as np
+
+    def main(a):
+        core.report(0, loss=np.float32(0.5), acc=np.array(2))
+        with pytest.raises(TypeError):
+            core.report(1, loss="0.5")
+        return {"r": a}
+
+    core.run(main, parameters=[GridSearchSpace("a", 0, [0])])
+    curves = core.load_metrics()[1]
+    assert [(list(x), list(y)) for x, y in (curves["acc"], curves["loss"])] == [
+        ([0], [2.0]), ([0], [0.5])]
@@ -0,0 +1,45 @@
+import pytest
+
+from tunetools import scheduler
+from tunetools.scheduler import SuccessiveHalving
+
+
+@pytest.mark.parametrize("min_step, reduction_factor, steps", [
+    (1, 3, {0: -1, 1: 0, 2: 0, 3: 1, 8: 1, 9: 2, 27: 3}),
+    (2, 2, {1: -1, 2: 0, 3: 0, 4: 1, 8: 2}),
+    (0.5, 2, {0: -1, 0.5: 0, 1: 1, 5: 3}),
+])
+def test_rung(min_step, reduction_factor, steps):
+    halving = SuccessiveHalving("loss", "min", min_step, reduction_factor)
+    assert dict((x, halving.rung(x)) for x in steps) == steps
+
+
+@pytest.mark.parametrize("min_step, reduction_factor", [(1, 1), (0, 3), (-1, 3), (1, 1.5)])
+def test_rung_rejects_degenerate_settings(min_step, reduction_factor):
+    # these made rung() loop forever
+    with pytest.raises(ValueError):
+        SuccessiveHalving("loss", "min", min_step, reduction_factor)
+
+
+def test_rejects_unknown_direction():
+    with pytest.raises(ValueError):
+        SuccessiveHalving("loss", "lowest")
+
+
+def test_promotable():
+    values = [5, 1, 4, 2, 6, 3]
+    # the best 1 / 3 of the 6 values: the 2 lowest, or the 2 highest
+    assert [scheduler.promotable(x, values, "min", 3) for x in values] == [
+        False, True, False, True, False, False]
+    assert [scheduler.promotable(x, values, "max", 3) for x in values] == [
+        True, False, False, False, True, False]
+    # the first trials reaching a rung always continue
+    assert scheduler.promotable(10, [10], "min", 3)
+    assert scheduler.promotable(10, [1, 10], "min", 3) is False
+    assert scheduler.promotable(1, [1, 10], "min", 3)
+
+
+def test_parse_capacity():
+    assert scheduler.parse_capacity(["cpu:8", "mem:32000"]) == {"cpu": 8.0, "mem": 32000.0}
+    with pytest.raises(ValueError):
+        scheduler.parse_capacity(["cpu x:8"])
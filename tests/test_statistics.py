@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tunetools import statistics
+
+FORMATTER = "{mean:.4f}"
+
+
+def _data(seed=0, rows=400):
+    # repeated samples of (param_g, param_b) with tied means, plus a constant parameter
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        "param_g": rng.randint(0, 4, rows),
+        "param_b": rng.choice([0.1, 0.2, 0.3], rows),
+        "param_c": np.ones(rows, dtype=int),
+        "ret_r": rng.randint(0, 3, rows) / 10,
+        "ret_s": rng.normal(size=rows),
+    })
+
+
+def _baseline_samples(data, keys, column):
+    # {keys: samples in the order of `data`}, as the row by row implementation grouped them
+    groups = {}
+    for _, row in data.iterrows():
+        groups.setdefault(tuple(row[k] for k in keys), []).append(row[column])
+    return dict(sorted(groups.items()))
+
+
+def _baseline_best(agg, group_by, targets):
+    # the first row of each group with the best mean, comparing the targets one after the other
+    best = {}
+    for i in range(len(agg)):
+        group = tuple(agg[x].iloc[i] for x in group_by)
+        if group not in best:
+            best[group] = i
+            continue
+        for column, direction in targets:
+            sign = 1 if direction == "min" else -1
+            current, other = agg[column].iloc[i].mean(), agg[column].iloc[best[group]].mean()
+            if sign * current < sign * other:
+                best[group] = i
+                break
+            if sign * current > sign * other:
+                break
+    return [best[x] for x in sorted(best)]
+
+
+def test_aggregate_samples_matches_baseline():
+    data = _data()
+    keys = ["param_g", "param_b"]
+    agg = statistics._aggregate_samples(data, keys, ["param_c"], ["ret_r", "ret_s"], FORMATTER)
+    for column in ["ret_r", "ret_s"]:
+        expected = _baseline_samples(data, keys, column)
+        assert [tuple(x) for x in agg[keys].itertuples(index=False)] == list(expected)
+        for wrapper, samples in zip(agg[column], expected.values()):
+            assert list(wrapper._array) == samples
+            # exactly sum() / len(), so that ties stay ties
+            assert wrapper.mean() == sum(samples) / len(samples)
+
+
+@pytest.mark.parametrize("targets", [[("ret_r", "min")], [("ret_r", "max"), ("ret_s", "min")]])
+def test_find_best_matches_baseline(targets):
+    data = _data(1)
+    agg = statistics._aggregate_samples(data, ["param_g", "param_b"], ["param_c"],
+                                        ["ret_r", "ret_s"], FORMATTER)
+    codes = agg.groupby(by=["param_g"], sort=True).ngroup().to_numpy()
+    best = statistics._find_best(codes, [(agg[x], d) for x, d in targets])
+    assert list(best) == _baseline_best(agg, ["param_g"], targets)
+
+
+def test_find_best_with_nan_mean():
+    agg = statistics._aggregate_samples(_data(2), ["param_g", "param_b"], [], ["ret_s"], FORMATTER)
+    agg.loc[0, "ret_s"] = statistics.ArrayWrapper([np.nan], FORMATTER)
+    codes = agg.groupby(by=["param_g"], sort=True).ngroup().to_numpy()
+    best = statistics._find_best(codes, [(agg["ret_s"], "min")])
+    assert list(best) == _baseline_best(agg, ["param_g"], [("ret_s", "min")])
+
+
+def test_aggregate_sums_matches_samples():
+    data = _data(3)
+    keys = ["param_g", "param_b"]
+    samples = statistics._aggregate_samples(data, keys, [], ["ret_s"], FORMATTER)
+    grouped = data.groupby(keys)["ret_s"]
+    sums = pd.DataFrame({"count_s": grouped.count(), "sum_s": grouped.sum(),
+                         "sumsq_s": grouped.apply(lambda x: (x * x).sum())}).reset_index()
+    agg = statistics._aggregate_sums(sums, keys, [], ["s"], FORMATTER)
+    for x, y in zip(samples["ret_s"], agg["ret_s"]):
+        assert x.count() == y.count()
+        assert y.mean() == pytest.approx(x.mean())
+        assert y.std() == pytest.approx(x.std())
+
+
+def test_identifiability_check():
+    data = _data()
+    with pytest.raises(ValueError, match="param_b|'b'"):
+        statistics._aggregate_samples(data, ["param_g"], ["param_b"], ["ret_r"], FORMATTER)
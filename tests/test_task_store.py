@@ -0,0 +1,160 @@
+import multiprocessing as mp
+import threading
+
+import pytest
+
+from tunetools import db_utils, server, writer
+from tunetools.server import ServerClient
+from tunetools.task_store import TaskStore
+from tunetools.writer import WriterClient
+
+COLUMNS = ["param_a"]
+
+
+def _store(db_path):
+    return TaskStore(db_utils.connect(db_path))
+
+
+def _statuses(db_path):
+    conn = db_utils.connect(db_path)
+    rows = dict(db_utils.execute_sql(conn, "SELECT ID, STATUS FROM RESULT"))
+    conn.close()
+    return rows
+
+
+def _claim_all(db_path, pid, claimed):
+    store = _store(db_path)
+    while True:
+        rows = store.claim(COLUMNS, 3, "host", pid, lease_ttl=60)
+        if len(rows) == 0:
+            break
+        claimed.put([x[0] for x in rows])
+    claimed.put(None)
+
+
+def _fork_context():
+    if "fork" not in mp.get_all_start_methods():
+        pytest.skip("needs the 'fork' start method")
+    return mp.get_context("fork")
+
+
+def test_concurrent_claim_with_lease(study):
+    context = _fork_context()
+    claimed = context.Queue()
+    processes = [context.Process(target=_claim_all, args=(study, 100 + i, claimed))
+                 for i in range(4)]
+    for p in processes:
+        p.start()
+    ids, done = [], 0
+    while done < len(processes):
+        x = claimed.get(timeout=60)
+        if x is None:
+            done += 1
+        else:
+            ids += x
+    for p in processes:
+        p.join()
+    assert sorted(ids) == list(range(1, 13))
+    assert set(_statuses(study).values()) == {"RUNNING"}
+
+
+def test_reclaim_expired_lease(study):
+    store = _store(study)
+    [(db_id, _)] = store.claim(COLUMNS, 1, "host", 1, lease_ttl=60)
+    assert store.claim(COLUMNS, 12, "host", 2, lease_ttl=60)[0][0] != db_id
+    store.reset([x for x in range(1, 13) if x != db_id], "host", 2)
+
+    db_utils.execute_sql(store.conn, "UPDATE RESULT SET LEASE_UNTIL = 0 WHERE ID = ?", [db_id])
+    store.conn.commit()
+    assert db_id in [x[0] for x in store.claim(COLUMNS, 12, "host", 3, lease_ttl=60)]
+    assert store.count_reclaims() == 1
+
+    # the first worker lost the task: its operations are dropped
+    assert not store.start(db_id, "host", 1)
+    assert not store.finish(db_id, {"STATUS": "TERMINATED"}, [], "host", 1)
+    assert store.reset([db_id], "host", 1) == 0
+    store.renew([db_id], 1000, "host", 1)
+    assert _statuses(study)[db_id] == "RUNNING"
+
+    assert store.finish(db_id, {"STATUS": "TERMINATED", "ret_r": 1}, [("ret_r", "INTEGER", None)],
+                        "host", 3)
+    assert _statuses(study)[db_id] == "TERMINATED"
+
+
+def test_no_reclaim_without_lease(study):
+    store = _store(study)
+    [(db_id, _)] = store.claim(COLUMNS, 1, "host", 1, lease_ttl=0)
+    assert db_id not in [x[0] for x in store.claim(COLUMNS, 12, "host", 2, lease_ttl=0)]
+    assert store.count_reclaims() == 0
+
+
+def test_writer_round_trip(study):
+    context = _fork_context()
+    requests, responses = context.Queue(), [context.Queue()]
+    process = context.Process(target=writer.serve, args=(study, requests, responses, 8, 0.01,
+                                                         1000))
+    process.start()
+    try:
+        client = WriterClient(0, requests, responses[0])
+        rows = client.claim(COLUMNS, 12)
+        assert len(rows) == 12
+        for db_id, a in rows:
+            assert client.finish(db_id, {"STATUS": "TERMINATED", "ret_r": a},
+                                 [("ret_r", "INTEGER", None)])
+        assert client.count_by_status() == {"TERMINATED": 12}
+        # an operation that fails comes back as the exception
+        with pytest.raises(Exception):
+            client.finish(1, {"NO_SUCH_COLUMN": 1}, [])
+    finally:
+        writer.stop(requests)
+        process.join(timeout=60)
+    assert set(_statuses(study).values()) == {"TERMINATED"}
+
+
+@pytest.fixture
+def coordinator(study):
+    # a coordinator on a free localhost port, requiring the token "secret"
+    started = threading.Event()
+    servers = []
+
+    def run():
+        # the server uses its connection from this thread
+        servers.append(server.make_server(study, "127.0.0.1", 0, token="secret"))
+        started.set()
+        servers[0].serve_forever()
+        servers[0].server_close()
+        servers[0].store.conn.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait(10)
+    yield "127.0.0.1:%d" % servers[0].server_address[1]
+    servers[0].shutdown()
+    thread.join(10)
+
+
+def test_coordinator_claim_finish(coordinator, study):
+    client = ServerClient(coordinator, token="secret")
+    rows = client.claim(COLUMNS, 5)
+    assert len(rows) == 5
+    for db_id, a in rows:
+        assert client.finish(db_id, {"STATUS": "TERMINATED", "ret_r": a},
+                             [("ret_r", "INTEGER", None)])
+    assert client.count_by_status() == {"TERMINATED": 5, "PENDING": 7}
+    assert sum(x == "TERMINATED" for x in _statuses(study).values()) == 5
+
+
+def test_coordinator_rejects_bad_requests(coordinator, study):
+    with pytest.raises(RuntimeError, match="token"):
+        ServerClient(coordinator).count_by_status()
+    client = ServerClient(coordinator, token="secret")
+    [(db_id, _)] = client.claim(COLUMNS, 1)
+    with pytest.raises(RuntimeError, match="column"):
+        client.finish(db_id, {"STATUS": "TERMINATED", "ret_r = 0, STATUS": 1}, [])
+    with pytest.raises(RuntimeError, match="column"):
+        client.claim(["ID) RETURNING *--"], 1)
+    with pytest.raises(RuntimeError, match="new column"):
+        client.finish(db_id, {"STATUS": "TERMINATED"}, [("ret_r", "TEXT DEFAULT 1", None)])
+    with pytest.raises(RuntimeError, match="task ids"):
+        client.reset("1")
+    assert _statuses(study)[db_id] == "RUNNING"
@@ -0,0 +1,64 @@
+import sqlite3
+
+from . import db_utils
+
+# The AGGREGATE table keeps COUNT, SUM and SUMSQ of every numeric result NAME per parameter
+# tuple (the param_* columns), over the TERMINATED tasks. It is opt-in (run --aggregate): once the
+# table exists, every finish updates it in the same transaction as the result, so that
+# `tunetools statistics --aggregate` reads one row per configuration instead of every sample.
+
+TABLE = "AGGREGATE"
+
+
+def enabled(conn: sqlite3.Connection):
+    return len(db_utils.get_columns(conn, TABLE)) != 0
+
+
+def _param_columns(conn, table_name):
+    return [x for x in db_utils.get_columns(conn, table_name) if x.startswith("param_")]
+
+
+def _metric_columns(conn):
+    cursor = db_utils.execute_sql(conn, "PRAGMA table_info(RESULT)")
+    return [x[1] for x in cursor if x[1].startswith("ret_") and x[2] in ("REAL", "INTEGER")]
+
+
+def ensure(conn: sqlite3.Connection, rebuild: bool = False):
+    # (re)builds the table if it is missing, or if the parameters changed
+    if (not rebuild and enabled(conn)
+            and _param_columns(conn, TABLE) == _param_columns(conn, "RESULT")):
+        return
+    cursor = db_utils.execute_sql(conn, "PRAGMA table_info(RESULT)")
+    params = [(x[1], x[2]) for x in cursor if x[1].startswith("param_")]
+    db_utils.execute_sql(conn, "DROP TABLE IF EXISTS %s" % TABLE)
+    columns = dict(params)
+    columns.update({"NAME": "TEXT", "COUNT": "INTEGER", "SUM": "REAL", "SUMSQ": "REAL"})
+    db_utils.create_table(conn, TABLE, columns)
+    param_columns = [x[0] for x in params]
+    db_utils.ensure_index(conn, TABLE, "IDX_AGGREGATE", param_columns + ["NAME"])
+    group_by = " GROUP BY " + ", ".join(param_columns) if len(param_columns) != 0 else ""
+    for column in _metric_columns(conn):
+        db_utils.execute_sql(conn, "INSERT INTO %s (%s) SELECT %s FROM RESULT WHERE STATUS = "
+                                   "'TERMINATED' AND %s IS NOT NULL%s" % (
+                                       TABLE, ", ".join(param_columns + ["NAME", "COUNT", "SUM",
+                                                                         "SUMSQ"]),
+                                       ", ".join(param_columns + [
+                                           "'%s'" % column[4:], "COUNT(*)", "SUM(%s)" % column,
+                                           "SUM(%s * %s)" % (column, column)]),
+                                       column, group_by))
+
+
+def add(conn: sqlite3.Connection, db_id: int, results: dict):
+    param_columns = _param_columns(conn, TABLE)
+    values = list(db_utils.select_first(conn, "RESULT", param_columns, where={"ID": db_id}) or [])
+    for name, value in results.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        cursor = db_utils.execute_sql(
+            conn, "UPDATE %s SET COUNT = COUNT + 1, SUM = SUM + ?, SUMSQ = SUMSQ + ? "
+                  "WHERE NAME = ?%s" % (TABLE, "".join(" AND %s IS ?" % x for x in param_columns)),
+            [value, value * value, name] + values)
+        if cursor.rowcount == 0:
+            row = dict(zip(param_columns, values))
+            row.update({"NAME": name, "COUNT": 1, "SUM": value, "SUMSQ": value * value})
+            db_utils.insert(conn, TABLE, [row])
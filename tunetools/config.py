@@ -4,3 +4,67 @@ _verbose = False
 def set_verbose(verbose):
     global _verbose
     _verbose = verbose
+
+
+_busy_timeout = 30.0
+
+
+def set_busy_timeout(busy_timeout):
+    global _busy_timeout
+    _busy_timeout = busy_timeout
+
+
+_lease_ttl = 300.0
+
+
+def set_lease_ttl(lease_ttl):
+    # a RUNNING task whose worker has not renewed its lease for this long is claimed again
+    # (0 disables the leases)
+    global _lease_ttl
+    _lease_ttl = lease_ttl
+
+
+_report_buffer_size = 256
+_report_flush_interval = 5.0
+
+
+def set_report(buffer_size=256, flush_interval=5.0):
+    # tt.report() keeps the metrics of a trial in memory, and writes them to the METRIC table
+    # once `buffer_size` values or `flush_interval` seconds have accumulated, and when it ends
+    global _report_buffer_size, _report_flush_interval
+    _report_buffer_size = buffer_size
+    _report_flush_interval = flush_interval
+
+
+_journal_sample = 1.0
+_journal_flush_interval = 1.0
+_journal_max_bytes = 64 * 1024 * 1024
+_journal_backup_count = 3
+
+
+def set_journal(sample=1.0, flush_interval=1.0, max_bytes=64 * 1024 * 1024, backup_count=3):
+    # sample: fraction of the statements written to .tune/db_journal.log (0 disables it)
+    global _journal_sample, _journal_flush_interval, _journal_max_bytes, _journal_backup_count
+    _journal_sample = sample
+    _journal_flush_interval = flush_interval
+    _journal_max_bytes = max_bytes
+    _journal_backup_count = backup_count
+
+
+_log_capture = "python"
+_log_flush_interval = 1.0
+_log_max_bytes = 0
+_log_backup_count = 1
+_log_compress = False
+
+
+def set_session_log(capture="python", flush_interval=1.0, max_bytes=0, backup_count=1,
+                    compress=False):
+    # capture: "python" redirects sys.stdout / sys.stderr, "fd" captures file descriptors 1 and 2
+    # max_bytes: rotate the trial log when it grows larger than this (0 means unlimited)
+    global _log_capture, _log_flush_interval, _log_max_bytes, _log_backup_count, _log_compress
+    _log_capture = capture
+    _log_flush_interval = flush_interval
+    _log_max_bytes = max_bytes
+    _log_backup_count = backup_count
+    _log_compress = compress
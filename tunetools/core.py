@@ -1,7 +1,13 @@
 import argparse
+import collections
+import contextvars
+import inspect
 import itertools
 import json
+import numbers
 import os
+import random
+import shutil
 import socket
 import sqlite3
 import time
@@ -11,6 +17,13 @@ from . import db_utils
 from . import config
 from .search_space import *
 from . import session_logger
+from . import scheduler
+from . import aggregate as _aggregate
+from .task_store import TaskStore, Heartbeat
+from .result_cache import ResultCache
+
+_SHUFFLE_KEY_RANGE = 1 << 62
+_DONE_STATUSES = ["TERMINATED", "PRUNED"]
 
 
 def _construct_config(
@@ -26,17 +39,6 @@ def _construct_config(
     return result
 
 
-def _construct_where(
-        parameters: Iterable,
-        values: Iterable
-):
-    result = {}
-    for p, v in zip(parameters, values):
-        if not p.ignore:
-            result[p.db_name] = v
-    return result
-
-
 def _print_config(
         config: dict,
         extra: str
@@ -49,25 +51,47 @@ def _print_config(
     print("=" * len(promt))
 
 
-def _prepare_db(
+def _prepare_schema(
         conn: sqlite3.Connection,
-        num_sample: int,
-        parameters: Iterable,
-        filter_function,
-        save_db=True
+        parameters: Iterable
 ):
-    with conn:
-        db_utils.create_table(conn, "RESULT", {
-            "ID": "INTEGER PRIMARY KEY AUTOINCREMENT",
-            "HOST": "TEXT NOT NULL",
-            "PID": "INTEGER NOT NULL",
-            "RUN_AT": "INTEGER",
-            "DURATION_MIN ": "REAL",
-            "STATUS": "TEXT DEFAULT PENDING"
-        })
-
-        db_utils.ensure_column(conn, "RESULT",
-                               [(x.db_name, x.base_type.db_type, x.default) for x in parameters])
+    # callers hold the write lock (db_utils.immediate_transaction)
+    db_utils.create_table(conn, "RESULT", {
+        "ID": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "HOST": "TEXT NOT NULL",
+        "PID": "INTEGER NOT NULL",
+        "RUN_AT": "INTEGER",
+        "DURATION_MIN ": "REAL",
+        "STATUS": "TEXT DEFAULT PENDING",
+        "SHUFFLE_KEY": "INTEGER",
+        "PRIORITY": "REAL DEFAULT 0",
+        "LEASE_UNTIL": "INTEGER",
+        "RECLAIMS": "INTEGER DEFAULT 0"
+    })
+    # the metrics reported at the rungs of successive halving
+    db_utils.create_table(conn, "RUNG", {
+        "TRIAL_ID": "INTEGER NOT NULL",
+        "RUNG": "INTEGER NOT NULL",
+        "VALUE": "REAL"
+    })
+    db_utils.ensure_index(conn, "RUNG", "IDX_RUNG", ["RUNG", "TRIAL_ID"])
+    # the learning curves reported by tt.report(), clustered by trial
+    db_utils.create_table(conn, "METRIC", {
+        "TRIAL_ID": "INTEGER NOT NULL",
+        "NAME": "TEXT NOT NULL",
+        "STEP": "INTEGER NOT NULL",
+        "VALUE": "REAL"
+    }, primary_key=["TRIAL_ID", "NAME", "STEP"], without_rowid=True)
+
+    db_utils.ensure_column(conn, "RESULT",
+                           [("SHUFFLE_KEY", "INTEGER", None), ("PRIORITY", "REAL", 0),
+                            ("LEASE_UNTIL", "INTEGER", None), ("RECLAIMS", "INTEGER", 0)] +
+                           [(x.db_name, x.base_type.db_type, x.default) for x in parameters])
+    _ensure_indexes(conn, parameters)
+    # tasks inserted by older versions have no shuffle key yet
+    db_utils.execute_sql(conn, "UPDATE RESULT SET SHUFFLE_KEY = ABS(RANDOM() %% %d) "
+                               "WHERE STATUS = 'PENDING' AND SHUFFLE_KEY IS NULL"
+                         % _SHUFFLE_KEY_RANGE)
 
     # check parameter compatibility
     old_param_files = os.path.join(".tune", "parameter.json")
@@ -92,40 +116,193 @@ def _prepare_db(
     with open(old_param_files, "w") as f:
         json.dump(old_params, f, indent=2)
 
-    param_space_sampled = [x.sample() for x in parameters]
-    insert_param = []
-    plan = []  # (parameters, number_to_execute, number_to_insert)
 
-    for param_tuple in itertools.product(*param_space_sampled):
-        if filter_function is not None:
-            config = _construct_config(parameters, param_tuple, {})
-            if not filter_function(**config):
-                continue
-        where = _construct_where(parameters, param_tuple)
-        current_count = db_utils.count(conn, "RESULT",
-                                       where=where)
-        where['STATUS'] = 'TERMINATED'
-        current_done_count = db_utils.count(conn, "RESULT",
-                                       where=where)
+def _iter_grid(
+        parameters: Iterable,
+        filter_function,
+        vectorized_filter=False,
+        batch_size=65536,
+        sampler: JointSampler = None
+):
+    if sampler is not None:
+        yield from _iter_sampled(parameters, filter_function, vectorized_filter, sampler)
+        return
+    domains = [x.sample() for x in parameters]
+    if filter_function is None or not vectorized_filter or len(domains) == 0:
+        for param_tuple in itertools.product(*domains):
+            if filter_function is not None:
+                config = _construct_config(parameters, param_tuple, {})
+                if not filter_function(**config):
+                    continue
+            yield param_tuple
+        return
+
+    # the filter gets one array per parameter for a whole batch of combinations, and
+    # returns a boolean mask. Combinations are enumerated in the same order as
+    # itertools.product.
+    import numpy as np
+    shape = [len(d) for d in domains]
+    columns = [np.array([x.base_type.python_type(v) for v in d]) for x, d in zip(parameters, domains)]
+    total = int(np.prod(shape))
+    for start in range(0, total, batch_size):
+        digits = np.unravel_index(np.arange(start, min(start + batch_size, total)), shape)
+        batch = dict((x.name, c[digit]) for x, c, digit in zip(parameters, columns, digits))
+        mask = np.broadcast_to(np.asarray(filter_function(**batch), dtype=bool),
+                               digits[0].shape)
+        selected = [[d[i] for i in digit[mask].tolist()] for d, digit in zip(domains, digits)]
+        yield from zip(*selected)
+
+
+def _iter_sampled(
+        parameters: Iterable,
+        filter_function,
+        vectorized_filter,
+        sampler: JointSampler
+):
+    points = sampler.sample(parameters)
+    if filter_function is None:
+        yield from points
+    elif vectorized_filter and len(parameters) != 0:
+        import numpy as np
+        batch = dict((x.name, np.array([x.base_type.python_type(p[i]) for p in points]))
+                     for i, x in enumerate(parameters))
+        mask = np.broadcast_to(np.asarray(filter_function(**batch), dtype=bool), (len(points),))
+        yield from itertools.compress(points, mask.tolist())
+    else:
+        for param_tuple in points:
+            if filter_function(**_construct_config(parameters, param_tuple, {})):
+                yield param_tuple
+
+
+def _iter_plan(
+        conn: sqlite3.Connection,
+        num_sample: int,
+        parameters: Iterable,
+        filter_function,
+        vectorized_filter=False,
+        sampler: JointSampler = None
+):
+    # yields (parameter values, number_to_execute, number_to_insert)
+    counts = _load_counts(conn, parameters)
+    for param_tuple in _iter_grid(parameters, filter_function, vectorized_filter,
+                                  sampler=sampler):
+        current_count, current_done_count = counts.get(_count_key(parameters, param_tuple),
+                                                       (0, 0))
         if current_done_count < num_sample:
-            model = {}
-            model_db = {
-                "HOST": socket.gethostname(),
-                "PID": os.getpid()
-            }
+            yield param_tuple, num_sample - current_done_count, num_sample - current_count
+
+
+def _prepare_db(
+        conn: sqlite3.Connection,
+        num_sample: int,
+        parameters: Iterable,
+        filter_function,
+        vectorized_filter=False,
+        cost_function=None,
+        order="random",
+        sampler: JointSampler = None,
+        result_cache: ResultCache = None,
+        aggregate=False,
+        force_values: dict = None
+):
+    if force_values is None:
+        force_values = {}
+    host, pid = socket.gethostname(), os.getpid()
+    columns = ["HOST", "PID", "SHUFFLE_KEY"] + [p.db_name for p in parameters]
+    # workers start at the same time: reconcile and insert under one write lock, so
+    # that only the first of them inserts the missing tasks
+    with db_utils.immediate_transaction(conn):
+        _prepare_schema(conn, parameters)
+        tasks = _iter_plan(conn, num_sample, parameters, filter_function, vectorized_filter,
+                           sampler)
+        resources = []
+        if cost_function is not None:
+            # the resources are the keys of the cost of the first task
+            first = next(tasks, None)
+            if first is not None:
+                tasks = itertools.chain([first], tasks)
+                resources = sorted(cost_function(**_construct_config(parameters, first[0],
+                                                                     force_values)))
+                db_utils.ensure_column(conn, "RESULT", [(scheduler.cost_column(x), "REAL", None)
+                                                        for x in resources])
+                columns += [scheduler.cost_column(x) for x in resources]
+
+        reused, used = [], []
+
+        def iter_rows():
+            for param_tuple, _, n_insert in tasks:
+                costs = []
+                if len(resources) != 0:
+                    costs = scheduler.cost_values(
+                        cost_function, _construct_config(parameters, param_tuple, force_values),
+                        resources)
+                if result_cache is not None:
+                    # the samples found in the result cache are inserted as TERMINATED
+                    config = _construct_config(parameters, param_tuple, result_cache.force_values)
+                    cached = result_cache.lookup(config, num_sample - n_insert, n_insert)
+                    if len(cached) != 0:
+                        used.append(config)
+                    for results, duration in cached:
+                        reused.append((dict(zip(columns, [host, pid, random.randrange(
+                            _SHUFFLE_KEY_RANGE)] + list(param_tuple) + costs)),
+                                       _result_put(results, duration, result_cache.force_values)))
+                    n_insert -= len(cached)
+                for _ in range(n_insert):
+                    yield ([host, pid, random.randrange(_SHUFFLE_KEY_RANGE)] + list(param_tuple)
+                           + costs)
+
+        # the result cache is only read here, its write lock is not nested in the study's
+        inserted = db_utils.insert_many(conn, "RESULT", columns, iter_rows())
+        if result_cache is not None:
+            for row, (put, ret_columns) in reused:
+                db_utils.ensure_column(conn, "RESULT", ret_columns)
+                row.update(put)
+                db_utils.insert(conn, "RESULT", [row])
+            if len(reused) != 0:
+                print("Reused %d cached result%s." % (len(reused), '' if len(reused) <= 1 else 's'))
+        if aggregate or _aggregate.enabled(conn):
+            _aggregate.ensure(conn, rebuild=len(reused) != 0)
+        scheduler.rank(conn, order)
+    if result_cache is not None:
+        result_cache.touch(used)
+    return inserted
+
+
+def _ensure_indexes(
+        conn: sqlite3.Connection,
+        parameters: Iterable
+):
+    # covers the grouped reconciliation in _prepare_db and the per-status queries
+    param_columns = [x.db_name for x in parameters if not x.ignore]
+    if len(param_columns) != 0:
+        db_utils.ensure_index(conn, "RESULT", "IDX_RESULT_PARAM", param_columns + ["STATUS"])
+    db_utils.ensure_index(conn, "RESULT", "IDX_RESULT_STATUS", ["STATUS", "RUN_AT"])
+    db_utils.ensure_index(conn, "RESULT", "IDX_RESULT_PENDING",
+                          ["STATUS", "PRIORITY", "SHUFFLE_KEY"], where="STATUS = 'PENDING'")
 
-            for p, v in zip(parameters, param_tuple):
-                model[p.name] = v
-                model_db[p.db_name] = v
 
-            plan.append((model, num_sample - current_done_count, num_sample - current_count))
-            if current_count < num_sample:
-                insert_param.extend([model_db] * (num_sample - current_count))
+def _count_key(
+        parameters: Iterable,
+        values: Iterable
+):
+    return tuple(p.base_type.python_type(v) if v is not None else None
+                 for p, v in zip(parameters, values) if not p.ignore)
 
-    if save_db:
-        db_utils.insert(conn, "RESULT", insert_param)
 
-    return plan
+def _load_counts(
+        conn: sqlite3.Connection,
+        parameters: Iterable
+):
+    # (non-ignored parameter values) -> (total count, terminated or pruned count)
+    keys = [p for p in parameters if not p.ignore]
+    counts = {}
+    cursor = db_utils.group_count(conn, "RESULT", [p.db_name for p in keys],
+                                  {"STATUS": _DONE_STATUSES})
+    for row in cursor:
+        if row[-2] == 0:
+            continue
+        counts[_count_key(keys, row[:-2])] = (row[-2], row[-1] or 0)
+    return counts
 
 
 def test(
@@ -139,7 +316,11 @@ def test(
         force_values = {}
     config = _construct_config(parameters, [x.default for x in parameters], force_values)
     _print_config(config, "TEST")
-    result = obj_function(**config)
+    if inspect.iscoroutinefunction(obj_function):
+        import asyncio
+        result = asyncio.run(obj_function(**config))
+    else:
+        result = obj_function(**config)
     print("result: " + str(result))
 
 
@@ -148,6 +329,10 @@ def plan(
         num_sample=1,
         parameters: list = None,
         force_values: dict = None,
+        analyze=False,
+        summary=False,
+        vectorized_filter=False,
+        sampler: JointSampler = None
 ):
     if parameters is None:
         parameters = []
@@ -156,37 +341,454 @@ def plan(
 
     if not os.path.isdir(".tune"):
         os.makedirs(".tune")
-    conn = sqlite3.connect(os.path.join(".tune", "tune.db"))
-    plan = _prepare_db(conn, num_sample, parameters, filter_function, False)
-    if len(plan) == 0:
-        print("No task will be executed!")
-        return
+    conn = db_utils.connect(os.path.join(".tune", "tune.db"))
+    with db_utils.immediate_transaction(conn):
+        _prepare_schema(conn, parameters)
+    if analyze:
+        db_utils.analyze(conn, "RESULT")
+
+    def iter_configs():
+        for values, n, n_insert in _iter_plan(conn, num_sample, parameters,
+                                              filter_function, vectorized_filter, sampler):
+            p = dict((x.name, v) for x, v in zip(parameters, values))
+            p.update(force_values)
+            yield p, n, n_insert
+
+    tasks = 0
     samples = 0
     samples_to_insert = 0
-    param_ranges = {}
-    for p, n, _ in plan:
-        p.update(force_values)
+    param_ranges = {}  # parameter -> {value -> number of tasks}
+    for p, n, n_insert in iter_configs():
+        tasks += 1
+        samples += n
+        samples_to_insert += n_insert
         for k, v in p.items():
-            param_set = param_ranges.get(k, set())
-            param_set.add(v)
-            param_ranges[k] = param_set
+            param_counter = param_ranges.setdefault(k, collections.Counter())
+            param_counter[v] += 1
+    if tasks == 0:
+        print("No task will be executed!")
+        return
     ignore_params = []
     for k, v in param_ranges.items():
         if len(v) == 1:
-            print("common parameter: %s, %s" % (k, v))
+            print("common parameter: %s, %s" % (k, set(v)))
             ignore_params.append(k)
-    for p, n, n_insert in plan:
-        for ignore_p in ignore_params:
-            del p[ignore_p]
-        samples += n
-        samples_to_insert += n_insert
-        print("(%d/%d) %s" % (n, n_insert, p))
+    if summary:
+        for k, v in param_ranges.items():
+            if k not in ignore_params:
+                print("%s: %s" % (k, ", ".join("%s (%d)" % x for x in v.items())))
+    else:
+        # stream the grid a second time rather than keeping every row in memory
+        for p, n, n_insert in iter_configs():
+            for ignore_p in ignore_params:
+                del p[ignore_p]
+            print("(%d/%d) %s" % (n, n_insert, p))
     print()
-    print("%d task%s / %d sample%s will be executed." % (len(plan), '' if len(plan) <= 1 else 's',
+    print("%d task%s / %d sample%s will be executed." % (tasks, '' if tasks <= 1 else 's',
                                                           samples, '' if samples <= 1 else 's'))
     print("%d sample%s will be inserted." % (samples_to_insert, '' if samples_to_insert <= 1 else 's'))
 
 
+def prepare(
+        filter_function=None,
+        num_sample=1,
+        parameters: list = None,
+        analyze=False,
+        vectorized_filter=False,
+        cost_function=None,
+        order="random",
+        sampler: JointSampler = None,
+        result_cache: ResultCache = None,
+        aggregate=False,
+        force_values: dict = None
+):
+    # reconcile the grid once, e.g. before forking workers that run with prepare=False
+    if parameters is None:
+        parameters = []
+
+    os.makedirs(".tune", exist_ok=True)
+    conn = db_utils.connect(os.path.join(".tune", "tune.db"))
+    inserted = _prepare_db(conn, num_sample, parameters, filter_function, vectorized_filter,
+                           cost_function, order, sampler, result_cache, aggregate, force_values)
+    if analyze:
+        db_utils.analyze(conn, "RESULT")
+    conn.close()
+    return inserted
+
+
+class TrialPruned(Exception):
+    # raised by report() when successive halving stops the trial
+    pass
+
+
+class _Trial:
+
+    def __init__(self, db_id, call, early_stopping):
+        self.db_id = db_id
+        self.call = call  # runs a store operation: call("rung", *args)
+        self.early_stopping = early_stopping
+        self.next_rung = 0
+        self.metrics = {}
+        self.buffer = []  # (step, name, value) not written yet
+        self.last_flush = time.time()
+
+    def add(self, step, metrics: dict):
+        for name, value in metrics.items():
+            self.buffer.append((step, name, value))
+        if (len(self.buffer) >= config._report_buffer_size
+                or time.time() - self.last_flush >= config._report_flush_interval):
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) != 0:
+            self.call("add_metrics", self.db_id, self.buffer)
+            self.buffer = []
+        self.last_flush = time.time()
+
+
+_current_trial = contextvars.ContextVar("tunetools_trial", default=None)
+
+
+def _metric_value(name, value):
+    # numpy scalars and 0-d tensors become float, anything else is an error
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if not isinstance(value, (str, bytes)):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    raise TypeError("report() expects numbers, but metric '%s' is %r" % (name, value))
+
+
+def report(step: int, **metrics):
+    # Reports the intermediate metrics of the running trial, kept as learning curves in the
+    # METRIC table (see load_metrics). With early stopping, raises TrialPruned when the trial
+    # is not among the best ones at a rung; the trial is then recorded as PRUNED with the last
+    # reported metrics.
+    metrics = dict((name, _metric_value(name, value)) for name, value in metrics.items())
+    trial = _current_trial.get()
+    if trial is None:
+        return
+    trial.metrics.update(metrics)
+    trial.add(step, metrics)
+    stopping = trial.early_stopping
+    if stopping is None or stopping.metric not in metrics:
+        return
+    rung = stopping.rung(step)
+    if rung < trial.next_rung:
+        return
+    trial.next_rung = rung + 1
+    if not trial.call("rung", trial.db_id, rung, metrics[stopping.metric], stopping.direction,
+                      stopping.reduction_factor):
+        raise TrialPruned("pruned at step %s (rung %d)" % (str(step), rung))
+
+
+def _checkpoint_path(db_id):
+    return os.path.abspath(os.path.join(".tune", "checkpoints", str(db_id)))
+
+
+def checkpoint_dir():
+    # The checkpoint directory of the running trial, .tune/checkpoints/<id>. It is kept when the
+    # trial goes back to PENDING (no result returned, or its worker died and the task is
+    # reclaimed), so the next run of the trial can resume from what it finds there; it is removed
+    # once the trial is done. Returns None outside of a trial, e.g. in `tunetools test`.
+    trial = _current_trial.get()
+    if trial is None:
+        return None
+    path = _checkpoint_path(trial.db_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_metrics(
+        trial_ids: list = None,
+        names: list = None,
+        conn: sqlite3.Connection = None
+):
+    # the learning curves reported by tt.report(): {trial id: {name: (steps, values)}}, with
+    # numpy arrays sorted by step
+    import numpy as np
+    own_conn = conn is None
+    if own_conn:
+        conn = db_utils.connect(os.path.join(".tune", "tune.db"))
+    sql = "SELECT TRIAL_ID, NAME, STEP, VALUE FROM METRIC"
+    conditions, parameters = [], []
+    if trial_ids is not None:
+        conditions.append("TRIAL_ID IN (%s)" % ", ".join(["?"] * len(trial_ids)))
+        parameters += list(trial_ids)
+    if names is not None:
+        conditions.append("NAME IN (%s)" % ", ".join(["?"] * len(names)))
+        parameters += list(names)
+    if len(conditions) != 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    # the primary key order, so SQLite does not sort
+    cursor = db_utils.execute_sql(conn, sql + " ORDER BY TRIAL_ID, NAME, STEP", parameters)
+    curves = {}
+    for (trial_id, name), rows in itertools.groupby(cursor, key=lambda x: x[:2]):
+        rows = list(rows)
+        curves.setdefault(trial_id, {})[name] = (np.array([x[2] for x in rows]),
+                                                 np.array([x[3] for x in rows], dtype=float))
+    if own_conn:
+        conn.close()
+    return curves
+
+
+def _result_put(
+        results: dict,
+        duration: float,
+        force_values: dict,
+        status: str = "TERMINATED"
+):
+    # (column values of a finished task, ret_* columns to ensure)
+    replace_dict = {
+        "STATUS": status,
+        "DURATION_MIN": duration
+    }
+    for k, v in results.items():
+        replace_dict['ret_' + k] = v
+    for k, v in force_values.items():
+        replace_dict['param_' + k] = v
+    return replace_dict, [("ret_" + k, TypeMap[type(v)].db_type, None) for k, v in results.items()]
+
+
+def _run_tasks(
+        store,
+        obj_function,
+        parameters: list,
+        force_values: dict,
+        worker_id: int,
+        lease: int,
+        heartbeat: Heartbeat,
+        capacity: dict = None,
+        early_stopping=None,
+        result_cache: ResultCache = None
+):
+    columns = [x.db_name for x in parameters]
+    run_count = 0
+    call = lambda op, *args: getattr(store, op)(*args)
+
+    leased = []
+    try:
+        while True:
+            if len(leased) == 0:
+                leased = store.claim(columns, lease, lease_ttl=heartbeat.lease_ttl,
+                                     capacity=capacity)
+                if len(leased) == 0:
+                    if capacity is not None and store.count_by_status().get("PENDING", 0) != 0:
+                        # wait for the running trials of this machine to free some capacity
+                        time.sleep(scheduler.WAIT_INTERVAL)
+                        continue
+                    break
+                heartbeat.hold([x[0] for x in leased])
+            elif not store.start(leased[0][0]):
+                # reclaimed while it waited in the batch, another worker may run it
+                heartbeat.release([leased.pop(0)[0]])
+                continue
+            x = leased.pop(0)
+            db_id = x[0]
+            values = x[1:]
+
+            config = _construct_config(parameters, values, force_values)
+            session_logger._start(db_id)
+            start = time.time()
+            _print_config(config, "RUN #%d IN #%d" % (run_count, worker_id))
+
+            results = None
+            status = "TERMINATED"
+            trial = _Trial(db_id, call, early_stopping)
+            token = _current_trial.set(trial)
+            try:
+                results = obj_function(**config)
+                run_count += 1
+            except TrialPruned as e:
+                print("Trial #%d is %s" % (db_id, str(e)))
+                results, status = dict(trial.metrics), "PRUNED"
+                run_count += 1
+            except BaseException as e:
+                import traceback
+                traceback.print_exc()
+                print("Trial #%d failed!! Set %s.STATUS = PENDING" % (db_id, str(db_id)))
+                store.reset([db_id])
+                heartbeat.release([db_id])
+                raise e
+            finally:
+                _current_trial.reset(token)
+                trial.flush()
+                session_logger._end(results is not None)
+
+            if results is None:
+                # run the trial again later, with the same checkpoint directory
+                print("No result returned!! Set %s.STATUS = PENDING" % str(db_id))
+                store.reset([db_id])
+                heartbeat.release([db_id])
+                continue
+
+            duration = (time.time() - start) / 60
+            finished = store.finish(db_id, *_result_put(results, duration, force_values, status))
+            heartbeat.release([db_id])
+            if not finished:
+                print("Trial #%d was reclaimed by another worker, its result is dropped." % db_id)
+                continue
+            shutil.rmtree(_checkpoint_path(db_id), ignore_errors=True)
+            if result_cache is not None and status == "TERMINATED":
+                result_cache.add(config, results, duration)
+    finally:
+        # give the leased but unstarted tasks back to the queue
+        if len(leased) != 0:
+            store.reset([x[0] for x in leased])
+    return run_count
+
+
+async def _run_tasks_async(
+        store,
+        obj_function,
+        parameters: list,
+        force_values: dict,
+        worker_id: int,
+        lease: int,
+        concurrency: int,
+        heartbeat: Heartbeat,
+        capacity: dict = None,
+        suggester=None,
+        early_stopping=None,
+        result_cache: ResultCache = None
+):
+    # Runs up to `concurrency` coroutine trials on one event loop. The blocking store
+    # operations go through a single thread, which also owns the local connection.
+    import asyncio
+    import concurrent.futures
+    import functools
+
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def call(function, *args):
+        return loop.run_in_executor(executor, functools.partial(function, *args))
+
+    if store is None:
+        store = await call(lambda: TaskStore(db_utils.connect(os.path.join(".tune", "tune.db")),
+                                             suggester))
+    columns = [x.db_name for x in parameters]
+    leased = collections.deque()
+    claim_lock = asyncio.Lock()
+    run_count = 0
+    # the tasks claimed and not finished nor reset yet, updated by the store thread itself, so
+    # that it stays right when a slot is cancelled while waiting for a store operation
+    running = set()
+
+    def claim():
+        claimed = store.claim(columns, lease, None, None, heartbeat.lease_ttl, capacity)
+        running.update(x[0] for x in claimed)
+        return claimed
+
+    def start(db_id):
+        started = store.start(db_id)
+        if not started:
+            running.discard(db_id)
+        return started
+
+    def finish(db_id, put, new_columns):
+        finished = store.finish(db_id, put, new_columns)
+        running.discard(db_id)
+        return finished
+
+    def reset(db_ids):
+        if len(db_ids) != 0:
+            store.reset(db_ids)
+        running.difference_update(db_ids)
+
+    async def next_task():
+        async with claim_lock:
+            while len(leased) != 0:
+                x = leased.popleft()
+                if await call(start, x[0]):
+                    return x
+                # reclaimed while it waited in the batch, another worker may run it
+                heartbeat.release([x[0]])
+            while True:
+                claimed = await call(claim)
+                if len(claimed) != 0 or capacity is None:
+                    break
+                if (await call(store.count_by_status)).get("PENDING", 0) == 0:
+                    break
+                # wait for the running trials of this machine to free some capacity
+                await asyncio.sleep(scheduler.WAIT_INTERVAL)
+            heartbeat.hold([x[0] for x in claimed])
+            leased.extend(claimed)
+            return leased.popleft() if len(leased) != 0 else None
+
+    async def run_slot(slot):
+        nonlocal run_count
+        while True:
+            x = await next_task()
+            if x is None:
+                return
+            db_id = x[0]
+            values = x[1:]
+
+            config = _construct_config(parameters, values, force_values)
+            log_file = session_logger._start_context(db_id)
+            start = time.time()
+            _print_config(config, "RUN #%d IN #%d.%d" % (run_count, worker_id, slot))
+
+            results = None
+            status = "TERMINATED"
+            # report() is synchronous: it waits for the store thread
+            trial = _Trial(db_id, lambda op, *args: executor.submit(
+                functools.partial(getattr(store, op), *args)).result(), early_stopping)
+            _current_trial.set(trial)
+            try:
+                results = await obj_function(**config)
+                run_count += 1
+            except TrialPruned as e:
+                print("Trial #%d is %s" % (db_id, str(e)))
+                results, status = dict(trial.metrics), "PRUNED"
+                run_count += 1
+            except BaseException as e:
+                # the task is reset with the other running ones when the slots stop
+                import traceback
+                traceback.print_exc()
+                raise e
+            finally:
+                trial.flush()
+                session_logger._end_context(log_file, results is not None)
+
+            if results is None:
+                # run the trial again later, with the same checkpoint directory
+                print("No result returned!! Set %s.STATUS = PENDING" % str(db_id))
+                await call(reset, [db_id])
+                heartbeat.release([db_id])
+                continue
+
+            duration = (time.time() - start) / 60
+            # a cancelled slot must not lose whether the result was committed
+            finished = await asyncio.shield(call(finish, db_id, *_result_put(
+                results, duration, force_values, status)))
+            heartbeat.release([db_id])
+            if not finished:
+                print("Trial #%d was reclaimed by another worker, its result is dropped." % db_id)
+                continue
+            shutil.rmtree(_checkpoint_path(db_id), ignore_errors=True)
+            if result_cache is not None and status == "TERMINATED":
+                await call(result_cache.add, config, results, duration)
+
+    session_logger._install_context()
+    slots = [asyncio.ensure_future(run_slot(i)) for i in range(concurrency)]
+    try:
+        await asyncio.gather(*slots)
+    finally:
+        for x in slots:
+            x.cancel()
+        await asyncio.gather(*slots, return_exceptions=True)
+        session_logger._uninstall_context()
+        # give back the leased and the interrupted tasks; the store thread runs this after the
+        # operations still in flight
+        await call(lambda: reset(list(running)))
+        executor.shutdown()
+    return run_count
+
+
 def run(
         obj_function,
         filter_function=None,
@@ -194,91 +796,69 @@ def run(
         parameters: list = None,
         force_values: dict = None,
         on_finish_function=None,
-        worker_id=0
+        worker_id=0,
+        analyze=False,
+        lease=1,
+        vectorized_filter=False,
+        store=None,
+        prepare=True,
+        concurrency=1,
+        cost_function=None,
+        capacity: dict = None,
+        order="random",
+        sampler: JointSampler = None,
+        suggester=None,
+        early_stopping=None,
+        result_cache: ResultCache = None,
+        aggregate=False
 ):
     if parameters is None:
         parameters = []
     if force_values is None:
         force_values = {}
+    if concurrency > 1 and not inspect.iscoroutinefunction(obj_function):
+        raise ValueError("concurrency > 1 needs an \"async def\" main function")
 
     os.makedirs(".tune", exist_ok=True)
-    conn = sqlite3.connect(os.path.join(".tune", "tune.db"))
-    _prepare_db(conn, num_sample, parameters, filter_function)
-    run_count = 0
-
-    while True:
-        with conn:
-            x = db_utils.select(conn, "RESULT",
-                                project=["ID"] + [x.db_name for x in parameters],
-                                where={"STATUS": "PENDING"},
-                                order_by="RANDOM()",
-                                limit=1, return_first=True)
-            values = None
-            if x is not None:
-                db_id = x[0]
-                db_utils.update(conn, "RESULT",
-                                put={
-                                    "HOST": socket.gethostname(),
-                                    "PID": os.getpid(),
-                                    "STATUS": "RUNNING",
-                                    "RUN_AT": int(time.time())
-                                },
-                                where={
-                                    "ID": db_id
-                                })
-                values = x[1:]
-
-        if values is None:
-            break
-
-        config = _construct_config(parameters, values, force_values)
-        session_logger._start(db_id)
-        start = time.time()
-        _print_config(config, "RUN #%d IN #%d" % (run_count, worker_id))
-
-        results = None
-        try:
-            results = obj_function(**config)
-            run_count += 1
-        except BaseException as e:
-            import traceback
-            traceback.print_exc()
-            raise e
-        finally:
-            if results is None:
-                print("No result returned!! Set %s.STATUS = PENDING" % str(db_id))
-                with conn:
-                    db_utils.update(conn, "RESULT", put={"STATUS": "PENDING"}, where={"ID": db_id})
-            session_logger._end(results is not None)
-
-        duration = (time.time() - start) / 60
-        with conn:
-            db_utils.ensure_column(conn, "RESULT",
-                                   [("ret_" + k, TypeMap[type(v)].db_type, None) for k, v in
-                                    results.items()])
-            replace_dict = {
-                "STATUS": "TERMINATED",
-                "DURATION_MIN": duration
-            }
-            for k, v in results.items():
-                replace_dict['ret_' + k] = v
-            for k, v in force_values.items():
-                replace_dict['param_' + k] = v
-            db_utils.update(conn, "RESULT",
-                            put=replace_dict,
-                            where={
-                                "ID": db_id
-                            })
+    conn = None
+    if store is None or prepare:
+        conn = db_utils.connect(os.path.join(".tune", "tune.db"))
+    if prepare:
+        _prepare_db(conn, num_sample, parameters, filter_function, vectorized_filter, cost_function,
+                    order, sampler, result_cache, aggregate, force_values)
+        if analyze:
+            db_utils.analyze(conn, "RESULT")
+
+    if store is None:
+        # the heartbeat thread renews the leases through its own connection
+        heartbeat = Heartbeat(lambda: TaskStore(db_utils.connect(os.path.join(".tune", "tune.db"))),
+                              config._lease_ttl)
+    else:
+        heartbeat = Heartbeat(lambda: store, config._lease_ttl)
+    try:
+        if inspect.iscoroutinefunction(obj_function):
+            import asyncio
+            run_count = asyncio.run(_run_tasks_async(store, obj_function, parameters, force_values,
+                                                     worker_id, lease, concurrency, heartbeat,
+                                                     capacity, suggester, early_stopping,
+                                                     result_cache))
+        else:
+            run_count = _run_tasks(store if store is not None else TaskStore(conn, suggester),
+                                   obj_function, parameters, force_values, worker_id, lease,
+                                   heartbeat, capacity, early_stopping, result_cache)
+    finally:
+        heartbeat.stop()
+        # worker processes exit without running atexit hooks
+        db_utils.flush_journal()
 
     # check if finish
     if on_finish_function is not None:
-        with conn:
-            total_count = db_utils.count(conn, "RESULT")
-            terminated_count = db_utils.count(conn, "RESULT", where={"STATUS": "TERMINATED"})
-            if total_count == terminated_count:
-                on_finish_function(run_count)
+        counts = (store if store is not None else TaskStore(conn)).count_by_status()
+        if sum(counts.values()) == sum(counts.get(x, 0) for x in _DONE_STATUSES):
+            on_finish_function(run_count)
 
-    conn.close()
+    if conn is not None:
+        conn.close()
 
 
 def test_or_run(
@@ -1,24 +1,153 @@
+import atexit
+import contextlib
+import itertools
 import os
+import random
 import sqlite3
+import threading
 import time
 from typing import Iterable, Dict
 from . import config
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_BUSY_RETRIES = 10
+_JOURNAL_BUFFER_LINES = 1000
+
+
+class _Journal:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = []
+        self.path = None
+        self.thread = None
+
+    def write(self, text):
+        with self.lock:
+            if self.path is None:
+                self.path = os.path.abspath(os.path.join(".tune", "db_journal.log"))
+            self.lines.append(time.ctime() + ": " + text + "\n")
+            if len(self.lines) >= _JOURNAL_BUFFER_LINES:
+                self._flush()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self.thread.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self.lines) == 0:
+            return
+        # every process appends to the same journal: the size check, the rotation and the append
+        # run under one file lock, so that the processes neither rotate twice nor interleave
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(self.path) and os.path.getsize(self.path) >= config._journal_max_bytes:
+                self._rotate()
+            with open(self.path, "a") as f:
+                f.writelines(self.lines)
+        self.lines = []
+
+    def _rotate(self):
+        for i in range(config._journal_backup_count - 1, 0, -1):
+            if os.path.isfile("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if config._journal_backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(config._journal_flush_interval)
+            self.flush()
+
+    def _after_fork(self):
+        # the parent process still owns (and flushes) the inherited lines
+        self.lock = threading.Lock()
+        self.lines = []
+        self.thread = None
+
+
+_journal = _Journal()
+atexit.register(_journal.flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_journal._after_fork)
+
+
+def _should_log():
+    sample = config._journal_sample
+    return sample >= 1 or (sample > 0 and random.random() < sample)
+
 
 def _write_log(text):
-    with open(os.path.join(".tune", "db_journal.log"), "a") as f:
-        f.write(time.ctime() + ": " + text + "\n")
+    _journal.write(text)
+
+
+def flush_journal():
+    _journal.flush()
+
+
+class Connection(sqlite3.Connection):
+    # caches the columns of each table, see get_columns
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schema_version = None
+        self.columns = {}
+
+
+def connect(path: str):
+    # WAL lets readers (e.g. `tunetools status`) run alongside the writing workers
+    conn = sqlite3.connect(path, timeout=config._busy_timeout, factory=Connection)
+    execute_sql(conn, "PRAGMA journal_mode=WAL")
+    return conn
+
+
+def _is_busy(error: sqlite3.OperationalError):
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+
+def _retry_on_busy(function, *args):
+    # the busy timeout already waits for the lock; back off and retry on top of it for
+    # the cases where SQLite gives up early (e.g. lock upgrades between writers)
+    delay = 0.05
+    for retry in itertools.count():
+        try:
+            return function(*args)
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or retry >= _BUSY_RETRIES:
+                raise
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 2)
 
 
 def execute_sql(conn: sqlite3.Connection, sql: str, parameters: Iterable = None):
-    if not sql.startswith("SELECT"):
+    if not sql.startswith(("SELECT", "PRAGMA", "BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK")) \
+            and _should_log():
         _write_log("%s (%s)" % (sql, parameters))
     if config._verbose:
         print(sql, parameters)
     if parameters is not None:
-        return conn.execute(sql, parameters)
+        return _retry_on_busy(conn.execute, sql, parameters)
     else:
-        return conn.execute(sql)
+        return _retry_on_busy(conn.execute, sql)
+
+
+@contextlib.contextmanager
+def immediate_transaction(conn: sqlite3.Connection):
+    # take the write lock up front, so that concurrent processes run the block one by one
+    with conn:
+        execute_sql(conn, "BEGIN IMMEDIATE")
+        yield conn
 
 
 def execute_sql_return_first(conn: sqlite3.Connection, sql: str, parameters: Iterable = None):
@@ -29,27 +158,50 @@ def execute_sql_return_first(conn: sqlite3.Connection, sql: str, parameters: Ite
 
 
 def execute_many(conn: sqlite3.Connection, sql: str, seq_of_parameters: list = None):
-    _write_log("%s (%s)...[%d]" % (sql, seq_of_parameters[0], len(seq_of_parameters)))
-    conn.executemany(sql, seq_of_parameters)
+    if _should_log():
+        _write_log("%s (%s)...[%d]" % (sql, seq_of_parameters[0], len(seq_of_parameters)))
+    _retry_on_busy(conn.executemany, sql, seq_of_parameters)
+
+
+def create_table(conn: sqlite3.Connection, table_name: str, columns: Dict,
+                 primary_key: list = None, without_rowid: bool = False):
+    definitions = ["%s %s" % (k, v) for k, v in columns.items()]
+    if primary_key is not None:
+        definitions.append("PRIMARY KEY (%s)" % ", ".join(primary_key))
+    sql = "CREATE TABLE IF NOT EXISTS `%s` (%s)" % (table_name, ", ".join(definitions))
+    if without_rowid:
+        sql += " WITHOUT ROWID"
+    execute_sql(conn, sql)
 
 
-def create_table(conn: sqlite3.Connection, table_name: str, columns: Dict):
-    sql = "CREATE TABLE IF NOT EXISTS `%s` (%s)" % (
-        table_name,
-        ", ".join(["%s %s" % (k, v) for k, v in columns.items()])
-    )
-    execute_sql(conn, sql)
+def _load_columns(conn: sqlite3.Connection, table_name: str):
+    cursor = execute_sql(conn, "PRAGMA table_info(`%s`)" % table_name)
+    return [x[1] for x in cursor]
 
 
 def get_columns(conn: sqlite3.Connection, table_name: str):
-    cursor = select(conn, table_name)
-    descriptions = list(cursor.description)
-    return [description[0] for description in descriptions]
+    cache = getattr(conn, "columns", None)
+    if cache is None:
+        return _load_columns(conn, table_name)
+    # the schema version changes whenever any process alters the schema
+    schema_version = execute_sql_return_first(conn, "PRAGMA schema_version")[0]
+    if schema_version != conn.schema_version:
+        cache.clear()
+        conn.schema_version = schema_version
+    if table_name not in cache:
+        cache[table_name] = _load_columns(conn, table_name)
+    return list(cache[table_name])
 
 
 def ensure_column(conn: sqlite3.Connection, table_name: str,
                   name_type_default: Iterable):
+    name_type_default = list(name_type_default)
+    cache = getattr(conn, "columns", {})
+    if table_name in cache and all(x[0] in cache[table_name] for x in name_type_default):
+        return []
+
     columns = get_columns(conn, table_name)
+    added = []
     for name, db_type, default in name_type_default:
         if name not in columns:
             if default is not None:
@@ -61,6 +213,38 @@ def ensure_column(conn: sqlite3.Connection, table_name: str,
                     table_name, name, db_type
                 ))
             execute_sql(conn, statement)
+            columns.append(name)
+            added.append(name)
+    if len(added) != 0:
+        cache.pop(table_name, None)
+    return added
+
+
+def get_index_columns(conn: sqlite3.Connection, index_name: str):
+    cursor = execute_sql(conn, "PRAGMA index_info(`%s`)" % index_name)
+    return [x[2] for x in cursor]
+
+
+def ensure_index(conn: sqlite3.Connection, table_name: str, index_name: str,
+                 columns: list, where: str = None):
+    # (re)build the index if it is missing or covers different columns
+    if get_index_columns(conn, index_name) == list(columns):
+        return False
+    execute_sql(conn, "DROP INDEX IF EXISTS `%s`" % index_name)
+    sql = "CREATE INDEX IF NOT EXISTS `%s` ON `%s` (%s)" % (
+        index_name, table_name, ", ".join(columns)
+    )
+    if where is not None:
+        sql += " WHERE " + where
+    execute_sql(conn, sql)
+    return True
+
+
+def analyze(conn: sqlite3.Connection, table_name: str = None):
+    if table_name is None:
+        execute_sql(conn, "ANALYZE")
+    else:
+        execute_sql(conn, "ANALYZE `%s`" % table_name)
 
 
 def update(conn: sqlite3.Connection, table_name: str, put: dict,
@@ -74,7 +258,33 @@ def update(conn: sqlite3.Connection, table_name: str, put: dict,
 
     parameters = [v for _, v in replace_items] + [v for _, v in where_items]
 
-    execute_sql(conn, sql, parameters)
+    return execute_sql(conn, sql, parameters)
+
+
+def claim(conn: sqlite3.Connection, table_name: str, project: list, put: dict,
+          where: str, order_by: str, limit: int = 1, key: str = "ID"):
+    # atomically pick up to `limit` rows matching `where` and update them with `put`
+    put_items = put.items()
+    subquery = "SELECT %s FROM `%s` WHERE %s ORDER BY %s LIMIT %d" % (
+        key, table_name, where, order_by, limit)
+    set_clause = ', '.join(['%s = ?' % k for k, _ in put_items])
+    parameters = [v for _, v in put_items]
+
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        sql = "UPDATE `%s` SET %s WHERE %s IN (%s) RETURNING %s" % (
+            table_name, set_clause, key, subquery, ", ".join(project))
+        return list(execute_sql(conn, sql, parameters))
+
+    # no RETURNING support: hold the write lock between the select and the update
+    if not conn.in_transaction:
+        execute_sql(conn, "BEGIN IMMEDIATE")
+    rows = list(execute_sql(conn, "SELECT %s FROM `%s` WHERE %s IN (%s)" % (
+        ", ".join(project), table_name, key, subquery)))
+    if len(rows) != 0:
+        keys = [x[project.index(key)] for x in rows]
+        execute_sql(conn, "UPDATE `%s` SET %s WHERE %s IN (%s)" % (
+            table_name, set_clause, key, ", ".join(["?"] * len(keys))), parameters + keys)
+    return rows
 
 
 def delete(conn: sqlite3.Connection, table_name: str, where: dict):
@@ -123,6 +333,27 @@ def count(conn: sqlite3.Connection, table_name: str, where: dict = None):
     return select_first(conn, table_name, project=["COUNT(*)"], where=where)[0]
 
 
+def group_count(conn: sqlite3.Connection, table_name: str, group_by: list,
+                count_where: dict):
+    # one row per group: (*group_by, total count, count of rows matching count_where), where a
+    # list value matches any of its items
+    where_items = count_where.items()
+    conditions = ['%s IN (%s)' % (k, ", ".join(["?"] * len(v))) if isinstance(v, list) else
+                  '%s = ?' % k for k, v in where_items]
+    project = list(group_by) + [
+        "COUNT(*)",
+        "SUM(CASE WHEN %s THEN 1 ELSE 0 END)" % " AND ".join(conditions)
+    ]
+    sql = "SELECT %s FROM `%s`" % (", ".join(project), table_name)
+    if len(group_by) != 0:
+        sql += " GROUP BY " + ", ".join(group_by)
+
+    parameters = []
+    for _, v in where_items:
+        parameters += v if isinstance(v, list) else [v]
+    return execute_sql(conn, sql, parameters)
+
+
 def insert(conn: sqlite3.Connection, table_name: str, contents: list):
     if len(contents) == 0:
         return
@@ -136,3 +367,20 @@ def insert(conn: sqlite3.Connection, table_name: str, contents: list):
         for model in contents
     ]
     execute_many(conn, sql, seq_of_params)
+
+
+def insert_many(conn: sqlite3.Connection, table_name: str, columns: list,
+                rows: Iterable, chunk_size: int = 1000):
+    sql = "INSERT INTO `%s` (%s) VALUES (%s)" % (
+        table_name, ", ".join(columns),
+        ", ".join(["?"] * (len(columns)))
+    )
+    rows = iter(rows)
+    total = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        execute_many(conn, sql, chunk)
+        total += len(chunk)
+    return total
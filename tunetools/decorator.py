@@ -14,7 +14,15 @@ def _check_env():
         _on_error("usage: tunetools {run,test,plan} python_file ...")
 
 
-def main(num_sample: int = 1):
+def main(num_sample: int = 1, search: str = "grid", budget: int = None, seed: int = 0,
+         target: str = None, direction: str = "min", early_stopping: str = None,
+         min_step: int = 1, reduction_factor: int = 3):
+    # search: "grid" runs every combination of the domains, while "random", "lhs" and "sobol"
+    # sample `budget` configurations jointly (with Uniform / LogUniform ranges). "tpe" starts
+    # from a few sampled configurations, then suggests the next ones from the finished tasks,
+    # to minimize or maximize (direction) the returned `target` value.
+    # early_stopping="asha" stops the trials whose `target` reported by tt.report() is weak at
+    # the steps min_step * reduction_factor ** k.
     def decorate(function):
         _check_env()
 
@@ -23,20 +31,60 @@ def main(num_sample: int = 1):
         signature = inspect.signature(function)
         search_spaces = []
         for parameter_name, p in signature.parameters.items():
-            annotation = p.annotation
-            search_spaces.append(
-                tt.GridSearchSpace(parameter_name, annotation.default, annotation.domain))
+            search_spaces.append(p.annotation.search_space(parameter_name))
         globals()['__parameters'] = search_spaces
+        if early_stopping is not None:
+            if early_stopping != "asha":
+                _on_error("@main(early_stopping=...) should be 'asha'.")
+            if target is None:
+                _on_error("@main(early_stopping='asha') needs the target reported by tt.report().")
+            if direction not in ("min", "max"):
+                _on_error("@main(direction=...) should be 'min' or 'max'.")
+            from tunetools import scheduler
+            globals()['__early_stopping'] = scheduler.SuccessiveHalving(target, direction, min_step,
+                                                                        reduction_factor)
+        if search != "grid":
+            if budget is None:
+                _on_error("@main(search='%s') needs a budget of configurations." % search)
+            if search == "tpe":
+                if target is None:
+                    _on_error("@main(search='tpe') needs the target to optimize.")
+                if direction not in ("min", "max"):
+                    _on_error("@main(direction=...) should be 'min' or 'max'.")
+                globals()['__suggest'] = (target, direction, budget, seed)
+                globals()['__sampler'] = tt.JointSampler("lhs", min(budget, 10), seed)
+            else:
+                globals()['__sampler'] = tt.JointSampler(search, budget, seed)
+        else:
+            for x in search_spaces:
+                if isinstance(x, tt.UniformSearchSpace):
+                    _on_error("Parameter '%s' is a range, which grid search cannot enumerate. Use "
+                              "@main(search='random' / 'lhs' / 'sobol', budget=...)." % x.name)
 
         return function
 
     return decorate
 
 
-def filtering(function):
+def filtering(function=None, vectorized: bool = False):
+    def decorate(function):
+        _check_env()
+
+        globals()['__filtering'] = function
+        globals()['__filtering_vectorized'] = vectorized
+
+        return function
+
+    if function is None:
+        return decorate
+    return decorate(function)
+
+
+def cost(function):
+    # returns the resources a trial needs, e.g. {"cpu": 2, "mem": 8000}, for run --capacity
     _check_env()
 
-    globals()['__filtering'] = function
+    globals()['__cost'] = function
 
     return function
 
@@ -75,6 +123,8 @@ def _prepare_env(args):
     _check_parameter(inspect.signature(globals()['__main']), params, "@main")
     if '__filtering' in globals():
         _check_parameter(inspect.signature(globals()['__filtering']), params, "@filtering")
+    if '__cost' in globals():
+        _check_parameter(inspect.signature(globals()['__cost']), params, "@cost")
 
     inject_strings = args.inject
     inject_dict = dict([x.split(':') for x in inject_strings])
@@ -91,31 +141,204 @@ def _prepare_env(args):
     return inject_dict
 
 
-def _run_single(args, worker_id):
-    injects = _prepare_env(args)
-    import time
-    time.sleep(worker_id * 2) # delay to avoid thread race
+def _configure(args):
+    if args.concurrency > 1 and not inspect.iscoroutinefunction(globals()['__main']):
+        _on_error("--concurrency needs an \"async def\" main function, which runs its trials on "
+                  "one event loop.")
+    tt.set_busy_timeout(args.busy_timeout)
+    tt.set_lease_ttl(args.lease_ttl)
+    tt.set_journal(sample=args.journal_sample)
+    tt.set_session_log(capture=args.log_capture, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                       compress=args.log_compress)
+
+
+def _run_main(args, injects, worker_id, store=None, prepare=True):
     tt.run(globals()['__main'],
            filter_function=globals().get('__filtering', None),
            num_sample=globals().get('__num_sample', 1),
            parameters=globals().get('__parameters', []),
            force_values=injects,
            on_finish_function=globals().get('__onfinish', None),
-           worker_id=worker_id)
+           worker_id=worker_id,
+           analyze=args.analyze,
+           lease=args.lease,
+           vectorized_filter=globals().get('__filtering_vectorized', False),
+           store=store,
+           prepare=prepare,
+           concurrency=args.concurrency,
+           cost_function=globals().get('__cost', None),
+           capacity=_capacity(args),
+           order=args.order,
+           sampler=globals().get('__sampler', None),
+           suggester=_suggester(),
+           early_stopping=globals().get('__early_stopping', None),
+           result_cache=_result_cache(args, injects),
+           aggregate=args.aggregate)
+
+
+def _suggester():
+    if '__suggest' not in globals():
+        return None
+    from tunetools import suggest
+    target, direction, budget, seed = globals()['__suggest']
+    return suggest.TPESuggester(globals().get('__parameters', []), target, direction, budget, seed,
+                                num_sample=globals().get('__num_sample', 1),
+                                filter_function=globals().get('__filtering', None),
+                                vectorized_filter=globals().get('__filtering_vectorized', False))
+
+
+def _result_cache(args, injects):
+    if args.result_cache is None:
+        return None
+    from tunetools import result_cache
+    return result_cache.ResultCache(args.result_cache,
+                                    result_cache.fingerprint(os.path.abspath(args.python_file)),
+                                    injects, args.result_cache_size)
+
+
+def _capacity(args):
+    if len(args.capacity) == 0:
+        return None
+    from tunetools import scheduler
+    try:
+        return scheduler.parse_capacity(args.capacity)
+    except ValueError:
+        _on_error("--capacity expects resource:amount pairs, e.g. --capacity cpu:8 mem:32000")
+
+
+def _run_single(args, worker_id, store=None):
+    injects = _prepare_env(args)
+    _configure(args)
+    _run_main(args, injects, worker_id, store, prepare=args.server is None)
+
+
+def _run_pool(args, stores):
+    # load the experiment and reconcile the grid once, then fork the workers
+    import multiprocessing as mp
+    from multiprocessing.connection import wait
+    if 'fork' not in mp.get_all_start_methods():
+        _on_error("--pool needs the 'fork' start method, which is not supported on this platform.")
+    context = mp.get_context('fork')
+
+    injects = _prepare_env(args)
+    _configure(args)
+    if args.server is None:
+        tt.prepare(filter_function=globals().get('__filtering', None),
+                   num_sample=globals().get('__num_sample', 1),
+                   parameters=globals().get('__parameters', []),
+                   analyze=args.analyze,
+                   vectorized_filter=globals().get('__filtering_vectorized', False),
+                   cost_function=globals().get('__cost', None),
+                   order=args.order,
+                   sampler=globals().get('__sampler', None),
+                   result_cache=_result_cache(args, injects),
+                   aggregate=args.aggregate,
+                   force_values=injects)
+
+    def spawn(worker_id):
+        p = context.Process(target=_run_main, args=(args, injects, worker_id, stores[worker_id],
+                                                     False))
+        p.daemon = True
+        p.start()
+        return p
+
+    processes = dict((i, spawn(i)) for i in range(args.worker))
+    respawn_count = 0
+    while len(processes) != 0:
+        wait([p.sentinel for p in processes.values()])
+        for worker_id, p in list(processes.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del processes[worker_id]
+            if p.exitcode == 0:
+                continue
+            _requeue(args, p.pid)
+            if respawn_count < args.max_respawn:
+                respawn_count += 1
+                print("Worker #%d exited with code %d, respawn it (%d/%d)." % (
+                    worker_id, p.exitcode, respawn_count, args.max_respawn))
+                processes[worker_id] = spawn(worker_id)
+            else:
+                print("Worker #%d exited with code %d." % (worker_id, p.exitcode))
+
+
+def _requeue(args, pid):
+    import socket
+    if args.server is not None:
+        from tunetools.server import ServerClient
+        count = ServerClient(args.server, token=args.token).requeue(socket.gethostname(), pid)
+    else:
+        from tunetools import db_utils
+        from tunetools.task_store import TaskStore
+        conn = db_utils.connect(os.path.join(".tune", "tune.db"))
+        count = TaskStore(conn).requeue(socket.gethostname(), pid)
+        conn.close()
+    if count != 0:
+        print("Set %d task%s of pid %d back to PENDING." % (count, '' if count <= 1 else 's', pid))
+
+
+def _server_client(args):
+    if args.server is None:
+        return None
+    from tunetools.server import ServerClient
+    return ServerClient(args.server, token=args.token)
+
+
+def _serve(args):
+    from tunetools import server
+    _prepare_env(args)
+    tt.set_busy_timeout(args.busy_timeout)
+    tt.prepare(filter_function=globals().get('__filtering', None),
+               num_sample=globals().get('__num_sample', 1),
+               parameters=globals().get('__parameters', []),
+               analyze=args.analyze,
+               vectorized_filter=globals().get('__filtering_vectorized', False),
+               cost_function=globals().get('__cost', None),
+               order=args.order,
+               sampler=globals().get('__sampler', None),
+               result_cache=_result_cache(args, {}),
+               aggregate=args.aggregate)
+    server.serve(os.path.abspath(os.path.join(".tune", "tune.db")), args.host, args.port,
+                 _suggester(), args.token)
+
 
 def _run(args):
-    if args.worker == 1:
-        _run_single(args, 0)
+    if args.server is not None and args.writer:
+        _on_error("--writer cannot be used with --server: the coordinator owns the database.")
+    if args.worker == 1 and not args.writer and not args.pool:
+        _run_single(args, 0, _server_client(args))
     else:
         import multiprocessing as mp
-        processes = []
-        for i in range(args.worker):
-            p = mp.Process(target=_run_single, args=(args, i))
-            p.daemon = True
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
+        stores = [_server_client(args)] * args.worker
+        if args.writer:
+            from tunetools import writer
+            # the writer runs the claims, so it suggests the configurations of an adaptive search
+            _prepare_env(args)
+            requests = mp.Queue()
+            responses = [mp.Queue() for _ in range(args.worker)]
+            writer_process = mp.Process(target=writer.serve,
+                                        args=(os.path.abspath(os.path.join(".tune", "tune.db")),
+                                              requests, responses, args.writer_batch,
+                                              args.writer_latency, 10, _suggester()))
+            writer_process.daemon = True
+            writer_process.start()
+            stores = [writer.WriterClient(i, requests, responses[i]) for i in range(args.worker)]
+        if args.pool:
+            _run_pool(args, stores)
+        else:
+            processes = []
+            for i in range(args.worker):
+                p = mp.Process(target=_run_single, args=(args, i, stores[i]))
+                p.daemon = True
+                p.start()
+                processes.append(p)
+            for p in processes:
+                p.join()
+        if args.writer:
+            writer.stop(requests)
+            writer_process.join()
+
 
 def _test(args):
     injects = _prepare_env(args)
@@ -126,7 +349,12 @@ def _test(args):
 
 def _plan(args):
     injects = _prepare_env(args)
+    tt.set_busy_timeout(args.busy_timeout)
     tt.plan(filter_function=globals().get('__filtering', None),
             num_sample=globals().get('__num_sample', 1),
             parameters=globals().get('__parameters', []),
-            force_values=injects)
+            force_values=injects,
+            analyze=args.analyze,
+            summary=args.summary,
+            vectorized_filter=globals().get('__filtering_vectorized', False),
+            sampler=globals().get('__sampler', None))
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import zipfile
+
+import numpy as np
+
+from . import db_utils
+from .search_types import TypeMap
+
+# Streams the RESULT table to a columnar file, chunk by chunk, so that notebooks can load or
+# memory-map the results without querying SQLite. Parquet and Arrow IPC files need pyarrow;
+# without it, the columns are written to a .npz archive instead.
+
+FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".npz": "npz"}
+
+
+def column_types(conn: sqlite3.Connection, columns: list, where: str = ""):
+    # The python type of each column, from the database type of search_types.TypeMap, widened
+    # to what is stored: SQLite keeps a REAL in an INTEGER column, or TEXT in a numeric one.
+    python_types = dict((x.db_type, python_type) for python_type, x in TypeMap.items())
+    declared = dict((x[1], x[2].upper()) for x in db_utils.execute_sql(
+        conn, "PRAGMA table_info(RESULT)"))
+    for x in columns:
+        if x not in declared:
+            raise ValueError("Unknown column: " + x)
+    stored = db_utils.execute_sql_return_first(conn, "SELECT %s FROM RESULT%s" % (", ".join(
+        "COUNT(CASE WHEN typeof(%s) = 'real' THEN 1 END), "
+        "COUNT(CASE WHEN typeof(%s) IN ('text', 'blob') THEN 1 END)" % (x, x)
+        for x in columns), where))
+    types = []
+    for i, x in enumerate(columns):
+        python_type = python_types.get(declared[x], str)
+        if stored[2 * i + 1] != 0:
+            python_type = str
+        elif python_type == int and stored[2 * i] != 0:
+            python_type = float
+        types.append(python_type)
+    return types
+
+
+def _select(column, python_type):
+    # the numbers of a str column are read as SQLite prints them, as LENGTH counts them
+    return "CAST(%s AS TEXT)" % column if python_type == str else column
+
+
+def default_columns(conn: sqlite3.Connection):
+    return ["ID", "STATUS", "DURATION_MIN"] + [
+        x for x in db_utils.get_columns(conn, "RESULT") if x.startswith(("param_", "ret_"))]
+
+
+def export(conn: sqlite3.Connection, path: str, columns: list = None, where: str = None,
+           chunk_size: int = 65536):
+    # returns (path written, number of rows)
+    if columns is None:
+        columns = default_columns(conn)
+    root, extension = os.path.splitext(path)
+    if extension not in FORMATS:
+        raise ValueError("Unknown format '%s', expected one of: %s" % (
+            extension, ", ".join(FORMATS)))
+    file_format = FORMATS[extension]
+    if file_format != "npz":
+        try:
+            import pyarrow
+        except ImportError:
+            path = root + ".npz"
+            print("pyarrow is not installed, export to %s instead." % path)
+            file_format = "npz"
+    where = "" if where is None else " WHERE " + where
+    with conn:
+        # one snapshot for all the queries, while the workers keep writing
+        db_utils.execute_sql(conn, "BEGIN")
+        types = column_types(conn, columns, where)
+        if file_format == "npz":
+            return path, _export_npz(conn, path, columns, types, where, chunk_size)
+        return path, _export_arrow(conn, path, columns, types, where, chunk_size, file_format)
+
+
+def _export_arrow(conn, path, columns, types, where, chunk_size, file_format):
+    import pyarrow as pa
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    schema = pa.schema([(x, arrow_types[t]) for x, t in zip(columns, types)])
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    count = 0
+    cursor = db_utils.execute_sql(conn, "SELECT %s FROM RESULT%s ORDER BY ID" % (
+        ", ".join(_select(x, t) for x, t in zip(columns, types)), where))
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            writer.write_batch(pa.record_batch(
+                [pa.array(list(x), type=t) for x, t in zip(zip(*rows), schema.types)],
+                schema=schema))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def _export_npz(conn, path, columns, types, where, chunk_size):
+    # One .npy member per column, written while its rows are read. An int column with NULLs
+    # becomes float with NaN, a NULL float is NaN and a NULL str is empty.
+    summary = db_utils.execute_sql_return_first(conn, "SELECT COUNT(*), %s FROM RESULT%s" % (
+        ", ".join("COUNT(%s), MAX(LENGTH(%s))" % (x, x) for x in columns), where))
+    count = summary[0]
+    with zipfile.ZipFile(path, "w", allowZip64=True) as archive:
+        for i, (column, python_type) in enumerate(zip(columns, types)):
+            non_null, max_length = summary[1 + 2 * i], summary[2 + 2 * i]
+            if python_type == str:
+                dtype, missing = np.dtype("<U%d" % max(max_length or 0, 1)), ""
+            elif python_type == int and non_null == count:
+                dtype, missing = np.dtype(np.int64), 0
+            else:
+                dtype, missing = np.dtype(np.float64), np.nan
+            with archive.open(column + ".npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, {
+                    "descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                    "shape": (count,)})
+                cursor = db_utils.execute_sql(conn, "SELECT %s FROM RESULT%s ORDER BY ID" % (
+                    _select(column, python_type), where))
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    member.write(np.array([missing if x[0] is None else x[0] for x in rows],
+                                          dtype=dtype).tobytes())
+    return count
@@ -1,13 +1,15 @@
 import argparse
 import os
 import socket
-import sqlite3
 import time
 import shutil
 import json
 
 from tunetools import db_utils
 from tunetools import decorator
+from tunetools import result_cache
+from tunetools import scheduler
+from tunetools.task_store import TaskStore
 
 
 def _get_db_conn(args):
@@ -15,10 +17,18 @@ def _get_db_conn(args):
     if not os.path.isfile(db_path):
         print("Error: cannot find .tune directory in the current working dir!")
         exit(-1)
-    return sqlite3.connect(db_path)
+    return db_utils.connect(db_path)
 
 
 def status(args):
+    if args.server is not None:
+        from tunetools.server import ServerClient
+        client = ServerClient(args.server, token=args.token)
+        counts = client.count_by_status()
+        print("Running: %d, Pending: %d, Terminated: %d, Pruned: %d, Reclaimed: %d" % (
+            counts.get("RUNNING", 0), counts.get("PENDING", 0), counts.get("TERMINATED", 0),
+            counts.get("PRUNED", 0), client.count_reclaims()))
+        return
     conn = _get_db_conn(args)
 
     with conn:
@@ -30,15 +40,40 @@ def status(args):
         if aver_duration is None:
             aver_duration = 60
             print("WARNING: I don't know the average duration. Use 60min for now.")
-        running_task = db_utils.select(conn, "RESULT", project=['ID', 'HOST', 'PID', 'RUN_AT'],
+        # per-configuration estimates, learned from all the finished tasks
+        model = scheduler.fit_duration_model(conn)
+        param_columns = model.columns
+        running_task = db_utils.select(conn, "RESULT",
+                                       project=['ID', 'HOST', 'PID', 'RUN_AT'] + param_columns,
                                        where={"STATUS": "RUNNING"})
         running_task = list(running_task)
-        count_pending = db_utils.count(conn, "RESULT", where={"STATUS": "PENDING"})
+        count_pending = 0
+        pending_duration = 0
+        if len(param_columns) != 0:
+            params = ", ".join(param_columns)
+            cursor = db_utils.execute_sql(conn, "SELECT %s, COUNT(*) FROM RESULT "
+                                                "WHERE STATUS = 'PENDING' GROUP BY %s" % (params, params))
+            for x in cursor:
+                count_pending += x[-1]
+                pending_duration += model.estimate(x[:-1], aver_duration) * x[-1]
+        else:
+            count_pending = db_utils.count(conn, "RESULT", where={"STATUS": "PENDING"})
+            pending_duration = count_pending * aver_duration
         count_running = len(running_task)
+        count_reclaims = TaskStore(conn).count_reclaims()
+        count_pruned = db_utils.count(conn, "RESULT", where={"STATUS": "PRUNED"})
     print("Running: %d, Pending: %d" % (count_running, count_pending))
+    if count_pruned != 0:
+        print("Pruned: %d (stopped early by successive halving)" % count_pruned)
+    if count_reclaims != 0:
+        print("Reclaimed: %d (tasks taken back from workers whose lease expired)" % count_reclaims)
     if count_running != 0:
         print("Speed: %lf/h" % (60 / aver_duration * count_running))
-        total_left_sec = (count_pending + count_running / 2) * aver_duration / count_running * 60
+        current = time.time()
+        running_estimates = [model.estimate(x[4:], aver_duration) for x in running_task]
+        running_left = sum(max(d * 60 - (current - x[3]), 0)
+                           for x, d in zip(running_task, running_estimates))
+        total_left_sec = (pending_duration * 60 + running_left) / count_running
 
         def format_time(left_sec):
             left_min = int(left_sec / 60)
@@ -49,12 +84,12 @@ def status(args):
         print("Left Time: %s (%s)" % (format_time(total_left_sec),
                                       time.ctime(time.time() + total_left_sec)))
         print("========================")
-        current = time.time()
-        for id, host, pid, run_at in running_task:
+        for x, estimate in zip(running_task, running_estimates):
+            id, host, pid, run_at = x[:4]
             this_duration = current - run_at
             print("[%s-%s] %.2lf%%, duration = %s, left = %s\t\t%s" % (
-                host, pid, this_duration / aver_duration / 60 * 100,
-                format_time(this_duration), format_time(aver_duration * 60 - this_duration),
+                host, pid, this_duration / estimate / 60 * 100,
+                format_time(this_duration), format_time(estimate * 60 - this_duration),
                 _get_last_line(os.path.join('.tune', 'logs', str(id) + '.log')).strip()
             ))
 
@@ -111,7 +146,19 @@ def statistics(args):
     from tunetools import statistics
     conn = _get_db_conn(args)
     with conn:
-        statistics._parse(conn, args.config, args.formatter, args.csv)
+        statistics._parse(conn, args.config, args.formatter, args.csv, args.aggregate)
+
+def export(args):
+    from tunetools import export
+    conn = _get_db_conn(args)
+    try:
+        path, count = export.export(conn, args.path, args.columns, args.where, args.chunk_size)
+    except ValueError as e:
+        print("Error: " + str(e))
+        exit(-1)
+    print("Export %d row%s to %s." % (count, '' if count <= 1 else 's', path))
+    conn.close()
+
 
 def draw(args):
     from tunetools import statistics
@@ -189,6 +236,39 @@ def main():
     run_parser.set_defaults(func=decorator._run)
     run_parser.add_argument('--worker', type=int, default=1, metavar='<worker>',
                             help='number of workers to run in parallel')
+    run_parser.add_argument('--lease', type=int, default=1, metavar='<lease>',
+                            help='number of tasks each worker claims at a time')
+    run_parser.add_argument('--capacity', nargs='*', type=str, default=[], metavar='resource:amount',
+                            help='resources of this machine shared by its workers, e.g. cpu:8 '
+                                 'mem:32000; a trial is only started when its @cost fits')
+    run_parser.add_argument('--lease-ttl', type=float, default=300, metavar='<seconds>',
+                            help='a running task is claimed again when its worker has not renewed '
+                                 'the lease for this long (0 disables the leases)')
+    run_parser.add_argument('--concurrency', type=int, default=1, metavar='<concurrency>',
+                            help='number of trials each worker runs at the same time on one event '
+                                 'loop, for an "async def" main function')
+    run_parser.add_argument('--pool', action='store_true',
+                            help='load the experiment and prepare the tasks once, then fork the '
+                                 'workers, respawning the ones that crash')
+    run_parser.add_argument('--max-respawn', type=int, default=10, metavar='<count>',
+                            help='maximum number of crashed workers respawned in --pool mode')
+    run_parser.add_argument('--writer', action='store_true',
+                            help='commit the database operations of all workers from one writer '
+                                 'process, in batches')
+    run_parser.add_argument('--writer-batch', type=int, default=64, metavar='<size>',
+                            help='maximum number of operations in one writer commit')
+    run_parser.add_argument('--writer-latency', type=float, default=0.01, metavar='<seconds>',
+                            help='maximum time the writer waits to fill a batch')
+    run_parser.add_argument('--journal-sample', type=float, default=1.0, metavar='<rate>',
+                            help='fraction of the database writes recorded in .tune/db_journal.log '
+                                 '(0 disables the journal)')
+    run_parser.add_argument('--log-capture', type=str, default='python', choices=['python', 'fd'],
+                            help="capture the trial output from sys.stdout/sys.stderr ('python'), or "
+                                 "from the file descriptors, including subprocesses ('fd')")
+    run_parser.add_argument('--log-max-mb', type=float, default=0, metavar='<size>',
+                            help='rotate a trial log when it exceeds this size (0 means unlimited)')
+    run_parser.add_argument('--log-compress', action='store_true',
+                            help='gzip the kept trial logs once the trial ends')
 
     test_parser = subparsers.add_parser('test',
                                         help='run the task by default values for once, but not record')
@@ -197,6 +277,46 @@ def main():
     plan_parser = subparsers.add_parser('plan',
                                         help='list all the parameter combinations that will be executed')
     plan_parser.set_defaults(func=decorator._plan)
+    plan_parser.add_argument('--summary', action='store_true',
+                             help='print the number of tasks per parameter value instead of every task')
+
+    run_parser.add_argument('--server', type=str, default=None, metavar='<host:port>',
+                            help='pull the tasks from a coordinator started by "tunetools serve"')
+
+    serve_parser = subparsers.add_parser('serve',
+                                         help='own the record database and hand out the tasks to '
+                                              '"tunetools run --server" workers')
+    serve_parser.set_defaults(func=decorator._serve, inject=[])
+    serve_parser.add_argument('python_file', type=str, default=None, metavar='<py_file>',
+                              help='a python file recording the experiment tuning configuarions')
+    serve_parser.add_argument('--host', type=str, default='127.0.0.1', metavar='<host>',
+                              help='address to listen on, e.g. 0.0.0.0 for all the interfaces')
+    serve_parser.add_argument('--port', type=int, default=7011, metavar='<port>')
+    serve_parser.add_argument('--token', type=str, default=os.environ.get('TUNETOOLS_TOKEN'),
+                              metavar='<token>',
+                              help='only accept the workers that send this token (default: '
+                                   '$TUNETOOLS_TOKEN)')
+
+    for subparser in [run_parser, serve_parser]:
+        subparser.add_argument('--order', type=str, default='random', choices=scheduler.ORDERS,
+                               help='claim the pending tasks in a random order, or the longest / '
+                                    'shortest first, as estimated from the finished tasks')
+        subparser.add_argument('--result-cache', type=str, nargs='?', default=None,
+                               const=result_cache.DEFAULT_PATH, metavar='<db_file>',
+                               help='reuse the results of identical configurations of the same '
+                                    'experiment source, shared across studies (default file: '
+                                    '~/.cache/tunetools/results.db)')
+        subparser.add_argument('--result-cache-size', type=int, default=100000, metavar='<entries>',
+                               help='evict the least recently used results beyond this count')
+        subparser.add_argument('--aggregate', action='store_true',
+                               help='maintain the count, sum and sum of squares of the results per '
+                                    'configuration, for statistics --aggregate')
+
+    for subparser in [run_parser, plan_parser, serve_parser]:
+        subparser.add_argument('--analyze', action='store_true',
+                               help='refresh the query planner statistics of the record database')
+        subparser.add_argument('--busy-timeout', type=float, default=30, metavar='<seconds>',
+                               help='how long to wait for a locked record database')
 
     for subparser in [run_parser, test_parser, plan_parser]:
         subparser.add_argument('python_file', type=str, default=None, metavar='<py_file>',
@@ -212,6 +332,14 @@ def main():
                                           help='show the running status')
     status_parser.set_defaults(func=status)
     status_parser.add_argument('--limit', type=int, default=20, metavar='<limit>')
+    status_parser.add_argument('--server', type=str, default=None, metavar='<host:port>',
+                               help='ask a coordinator started by "tunetools serve"')
+
+    for subparser in [run_parser, status_parser]:
+        subparser.add_argument('--token', type=str, default=os.environ.get('TUNETOOLS_TOKEN'),
+                               metavar='<token>',
+                               help='the token of the coordinator given with --server (default: '
+                                    '$TUNETOOLS_TOKEN)')
 
     store_parser = subparsers.add_parser('store',
                                          help='backup records')
@@ -240,6 +368,22 @@ def main():
                                    help="number formatter. Default: [{count}] {mean:.4f}±{std:.4f}")
     statistics_parser.add_argument("--csv", action='store_true',
                                    help="print as csv format")
+    statistics_parser.add_argument("--aggregate", action='store_true',
+                                   help="read the per-configuration sums maintained by run "
+                                        "--aggregate instead of every result (no t_test)")
+
+    export_parser = subparsers.add_parser('export',
+                                          help='write the records to a Parquet, Arrow or .npz file')
+    export_parser.set_defaults(func=export)
+    export_parser.add_argument('path', type=str, default=None, metavar='<file>',
+                               help='*.parquet, *.arrow / *.feather (need pyarrow) or *.npz')
+    export_parser.add_argument('--columns', nargs='*', type=str, default=None, metavar='<column>',
+                               help='the RESULT columns to export, e.g. param_lr ret_result '
+                                    '(default: ID, STATUS, DURATION_MIN and the param_ / ret_ ones)')
+    export_parser.add_argument('--where', type=str, default="STATUS = 'TERMINATED'",
+                               metavar='<condition>', help='an SQL condition on the rows to export')
+    export_parser.add_argument('--chunk-size', type=int, default=65536, metavar='<rows>',
+                               help='the number of rows read and written at a time')
 
     statistics_parser = subparsers.add_parser('draw',
                                               help='draw with the json from statistics')
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import db_utils
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tunetools", "results.db")
+
+
+def fingerprint(path: str):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ResultCache:
+    # Results shared across studies, keyed by the sha256 of the executed configuration and of
+    # the experiment source, so moving an experiment or cleaning .tune never recomputes a trial.
+    # A key holds one entry per sample; the least recently used entries beyond `max_entries`
+    # are evicted. `force_values` are the injected values the configurations run with.
+
+    def __init__(self, path: str, source_fingerprint: str, force_values: dict = None,
+                 max_entries: int = 100000):
+        self.path = path
+        self.source_fingerprint = source_fingerprint
+        self.force_values = force_values if force_values is not None else {}
+        self.max_entries = max_entries
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def key(self, config: dict):
+        text = json.dumps({"config": config, "source": self.source_fingerprint}, sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def connection(self):
+        # one connection per process and thread, the schema is created by the first one
+        if getattr(self.local, "pid", None) == os.getpid():
+            return self.local.conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = db_utils.connect(self.path)
+        with db_utils.immediate_transaction(conn):
+            db_utils.create_table(conn, "CACHE", {
+                "KEY": "TEXT NOT NULL",
+                "SAMPLE": "INTEGER NOT NULL",
+                "RESULT": "TEXT NOT NULL",
+                "DURATION_MIN": "REAL",
+                "LAST_USED": "INTEGER"
+            }, primary_key=["KEY", "SAMPLE"])
+            db_utils.ensure_index(conn, "CACHE", "IDX_CACHE_LAST_USED", ["LAST_USED"])
+        self.local.pid, self.local.conn = os.getpid(), conn
+        return conn
+
+    def lookup(self, config: dict, first: int, count: int):
+        # [(results, duration)] of at most `count` samples of `config`, skipping the `first` ones;
+        # read only, the caller touches the keys it used
+        rows = db_utils.execute_sql(self.connection(), "SELECT RESULT, DURATION_MIN FROM CACHE "
+                                                       "WHERE KEY = ? ORDER BY SAMPLE LIMIT ? OFFSET ?",
+                                    [self.key(config), count, first])
+        return [(json.loads(x[0]), x[1]) for x in rows]
+
+    def touch(self, configs: list):
+        # mark the entries of `configs` as recently used, in one short transaction
+        if len(configs) == 0:
+            return
+        conn = self.connection()
+        now = int(time.time())
+        with db_utils.immediate_transaction(conn):
+            db_utils.execute_many(conn, "UPDATE CACHE SET LAST_USED = ? WHERE KEY = ?",
+                                  [(now, self.key(x)) for x in configs])
+
+    def add(self, config: dict, results: dict, duration: float):
+        # called once per trial: the workers only add the results that TaskStore.finish recorded,
+        # and a worker whose lease was reclaimed can no longer finish the task
+        conn = self.connection()
+        key = self.key(config)
+        with db_utils.immediate_transaction(conn):
+            db_utils.execute_sql(conn, "INSERT INTO CACHE (KEY, SAMPLE, RESULT, DURATION_MIN, LAST_USED) "
+                                       "SELECT ?, COALESCE(MAX(SAMPLE) + 1, 0), ?, ?, ? FROM CACHE WHERE KEY = ?",
+                                 [key, json.dumps(results), duration, int(time.time()), key])
+            excess = db_utils.count(conn, "CACHE") - self.max_entries
+            if excess > 0:
+                db_utils.execute_sql(conn, "DELETE FROM CACHE WHERE rowid IN (SELECT rowid FROM CACHE "
+                                           "ORDER BY LAST_USED LIMIT ?)", [excess])
@@ -0,0 +1,151 @@
+import sqlite3
+from typing import Iterable
+
+from . import db_utils
+
+# A trial declares its cost with @decorator.cost, e.g. {"cpu": 2, "mem": 8000}. The cost is
+# stored in one cost_<resource> column per resource when the task is inserted, and a worker
+# started with a capacity only claims the tasks that fit into what the RUNNING tasks of its
+# host leave free. A missing cost counts as 0.
+
+WAIT_INTERVAL = 1.0
+
+
+def cost_column(resource: str):
+    return "cost_" + resource
+
+
+def parse_capacity(strings: list):
+    # ["cpu:8", "mem:32000"] -> {"cpu": 8.0, "mem": 32000.0}
+    capacity = {}
+    for x in strings:
+        resource, amount = x.split(":")
+        if not resource.isidentifier():
+            raise ValueError("invalid resource name: " + resource)
+        capacity[resource] = float(amount)
+    return capacity
+
+
+def cost_values(cost_function, config: dict, resources: list):
+    cost = cost_function(**config)
+    unknown = sorted(set(cost) - set(resources))
+    if len(unknown) != 0:
+        # the cost_* columns come from the first task, a resource it lacks would be dropped
+        raise ValueError("The cost of %s declares %s, which the cost of the first task does not; "
+                         "declare every resource in every cost, with 0 if unused." % (
+                             config, ", ".join(unknown)))
+    return [float(cost.get(x, 0)) for x in resources]
+
+
+def claim_where(conn: sqlite3.Connection, capacity: dict, host: str):
+    where = "STATUS = 'PENDING'"
+    columns = db_utils.get_columns(conn, "RESULT")
+    resources = [x for x in capacity if cost_column(x) in columns]
+    if len(resources) == 0:
+        return where
+    used = db_utils.execute_sql_return_first(
+        conn, "SELECT COUNT(*), %s FROM RESULT WHERE STATUS = 'RUNNING' AND HOST = ?" % ", ".join(
+            "SUM(COALESCE(%s, 0))" % cost_column(x) for x in resources), [host])
+    if used[0] == 0:
+        # an idle machine runs any trial, even one larger than its capacity
+        return where
+    return where + "".join(" AND COALESCE(%s, 0) <= %r" % (cost_column(x), capacity[x] - (u or 0))
+                           for x, u in zip(resources, used[1:]))
+
+
+class DurationModel:
+    # Estimates DURATION_MIN of a configuration additively: the mean duration of the finished
+    # tasks, corrected by how far the mean of each of its parameter values is from it.
+
+    def __init__(self, columns: list, rows: Iterable):
+        self.columns = columns
+        self.mean = None
+        self.minimum = None
+        sums = [{} for _ in columns]  # value -> [sum of durations, count]
+        total, count = 0, 0
+        for row in rows:
+            duration = row[-1]
+            total += duration
+            count += 1
+            self.minimum = duration if self.minimum is None else min(self.minimum, duration)
+            for value_sums, value in zip(sums, row[:-1]):
+                value_sum = value_sums.setdefault(value, [0, 0])
+                value_sum[0] += duration
+                value_sum[1] += 1
+        if count != 0:
+            self.mean = total / count
+        self.effects = [dict((k, s / n - self.mean) for k, (s, n) in value_sums.items())
+                        for value_sums in sums]
+
+    def estimate(self, values: Iterable, default: float = None):
+        if self.mean is None:
+            return default
+        estimate = self.mean + sum(effects.get(v, 0) for effects, v in zip(self.effects, values))
+        return max(estimate, self.minimum)
+
+
+def fit_duration_model(conn: sqlite3.Connection):
+    columns = [x for x in db_utils.get_columns(conn, "RESULT") if x.startswith("param_")]
+    cursor = db_utils.execute_sql(conn, "SELECT %s FROM RESULT WHERE STATUS = 'TERMINATED' "
+                                        "AND DURATION_MIN IS NOT NULL" % ", ".join(
+                                            columns + ["DURATION_MIN"]))
+    return DurationModel(columns, cursor)
+
+
+ORDERS = ["random", "longest", "shortest"]
+
+
+def rank(conn: sqlite3.Connection, order: str):
+    # Sets the PRIORITY the pending tasks are claimed in (lowest first, then by SHUFFLE_KEY):
+    # "longest" first shortens the makespan, "shortest" first gives early feedback.
+    if order == "random":
+        db_utils.execute_sql(conn, "UPDATE RESULT SET PRIORITY = 0 "
+                                   "WHERE STATUS = 'PENDING' AND PRIORITY != 0")
+        return
+    model = fit_duration_model(conn)
+    columns = model.columns
+    if model.mean is None or len(columns) == 0:
+        return
+    sign = -1 if order == "longest" else 1
+    configs = list(db_utils.execute_sql(conn, "SELECT DISTINCT %s FROM RESULT "
+                                              "WHERE STATUS = 'PENDING'" % ", ".join(columns)))
+    if len(configs) == 0:
+        return
+    db_utils.execute_many(conn, "UPDATE RESULT SET PRIORITY = ? WHERE STATUS = 'PENDING' AND %s"
+                          % " AND ".join("%s IS ?" % x for x in columns),
+                          [[sign * model.estimate(x)] + list(x) for x in configs])
+
+
+class SuccessiveHalving:
+    # Asynchronous successive halving (ASHA): rung k is reached at step
+    # min_step * reduction_factor ** k. A trial reaching a rung continues only while its metric is
+    # among the best 1 / reduction_factor of the trials that reached the rung before it, so the
+    # workers move on to new configurations instead of finishing the weak ones.
+
+    def __init__(self, metric: str, direction: str = "min", min_step: int = 1,
+                 reduction_factor: int = 3):
+        if direction not in ("min", "max"):
+            raise ValueError("direction must be 'min' or 'max', but found: " + str(direction))
+        # the rungs would never grow apart, and rung() would not end
+        if min_step <= 0:
+            raise ValueError("min_step must be positive, but found: " + str(min_step))
+        if reduction_factor < 2:
+            raise ValueError("reduction_factor must be at least 2, but found: " + str(reduction_factor))
+        self.metric = metric
+        self.direction = direction
+        self.min_step = min_step
+        self.reduction_factor = reduction_factor
+
+    def rung(self, step):
+        # the highest rung reached at `step`, or -1
+        rung = -1
+        while step >= self.min_step * self.reduction_factor ** (rung + 1):
+            rung += 1
+        return rung
+
+
+def promotable(value: float, values: list, direction: str, reduction_factor: int):
+    # `values` holds every value recorded at the rung, including `value`
+    ranked = sorted(values, reverse=direction == "max")
+    threshold = ranked[max(len(ranked) // reduction_factor, 1) - 1]
+    return value <= threshold if direction == "min" else value >= threshold
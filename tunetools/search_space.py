@@ -1,3 +1,5 @@
+import math
+
 from .search_types import *
 
 
@@ -20,6 +22,10 @@ class BaseSearchSpace:
     def sample(self) -> list:
         pass
 
+    def from_unit(self, u: float):
+        # maps a coordinate in [0, 1) of a joint sample to a value
+        pass
+
 
 class GridSearchSpace(BaseSearchSpace):
 
@@ -35,7 +41,98 @@ class GridSearchSpace(BaseSearchSpace):
     def sample(self) -> list:
         return self.domain
 
+    def from_unit(self, u: float):
+        return self.domain[min(int(u * len(self.domain)), len(self.domain) - 1)]
+
+
+class UniformSearchSpace(BaseSearchSpace):
+    # a range [low, high] that is only sampled jointly, see JointSampler. With log=True, the
+    # values are uniform in log space. An int range includes both ends.
+
+    def __init__(self, name: str, default, low, high, log: bool = False, ignore: bool = False):
+        base_type = TypeMap[type(default)]
+        super().__init__(name, base_type, default, ignore)
+        if base_type == String:
+            raise ValueError("a range cannot be a str parameter: " + name)
+        if not low < high:
+            raise ValueError("low must be less than high: %s, %s" % (str(low), str(high)))
+        if log and low <= 0:
+            raise ValueError("a log range must be positive: %s, %s" % (str(low), str(high)))
+        self.low, self.high, self.log = low, high, log
+
+    def sample(self) -> list:
+        raise ValueError("Parameter '%s' is a range, which grid search cannot enumerate. Use "
+                         "@main(search='random' / 'lhs' / 'sobol', budget=...)." % self.name)
+
+    def from_unit(self, u: float):
+        high = self.high + 1 if self.base_type == Int else self.high
+        if self.log:
+            value = math.exp(math.log(self.low) + u * (math.log(high) - math.log(self.low)))
+        else:
+            value = self.low + u * (high - self.low)
+        if self.base_type == Int:
+            return min(int(math.floor(value)), self.high)
+        return min(float(value), self.high)
+
+    def to_unit(self, value) -> float:
+        # the inverse of from_unit (the middle of the interval of an int value)
+        high = self.high + 1 if self.base_type == Int else self.high
+        if self.base_type == Int:
+            value = value + 0.5
+        if self.log:
+            return (math.log(value) - math.log(self.low)) / (math.log(high) - math.log(self.low))
+        return (value - self.low) / (high - self.low)
+
+
+class JointSampler:
+    # Draws `budget` configurations over all the parameters at once: independently at random,
+    # as a Latin hypercube or as a scrambled Sobol sequence. A grid parameter takes the domain
+    # value its coordinate falls in. The same seed gives the same points in every worker.
+
+    METHODS = ["random", "lhs", "sobol"]
+
+    def __init__(self, method: str, budget: int, seed: int = 0):
+        if method not in JointSampler.METHODS:
+            raise ValueError("unknown search method: %s, expected one of %s"
+                             % (method, JointSampler.METHODS))
+        self.method, self.budget, self.seed = method, budget, seed
+
+    def sample(self, parameters: list) -> list:
+        if len(parameters) == 0:
+            return [()] * self.budget
+        if self.method == "random":
+            import numpy as np
+            points = np.random.default_rng(self.seed).random((self.budget, len(parameters)))
+        elif self.method == "lhs":
+            from scipy.stats import qmc
+            points = qmc.LatinHypercube(d=len(parameters), seed=self.seed).random(self.budget)
+        else:
+            import warnings
+            from scipy.stats import qmc
+            with warnings.catch_warnings():
+                # a budget that is not a power of 2 only loses some of the balance
+                warnings.simplefilter("ignore")
+                points = qmc.Sobol(d=len(parameters), seed=self.seed).random(self.budget)
+        return [tuple(x.from_unit(u) for x, u in zip(parameters, point)) for point in points.tolist()]
+
 
 class Parameter:
     def __init__(self, default, domain: list):
-        self.default, self.domain = default, domain
\ No newline at end of file
+        self.default, self.domain = default, domain
+
+    def search_space(self, name: str):
+        return GridSearchSpace(name, self.default, self.domain)
+
+
+class Uniform:
+    def __init__(self, default, low, high):
+        self.default, self.low, self.high = default, low, high
+
+    def search_space(self, name: str):
+        return UniformSearchSpace(name, self.default, self.low, self.high)
+
+
+class LogUniform(Uniform):
+
+    def search_space(self, name: str):
+        return UniformSearchSpace(name, self.default, self.low, self.high, log=True)
\ No newline at end of file
@@ -0,0 +1,248 @@
+import hmac
+import json
+import numbers
+import os
+import re
+import socket
+import urllib.error
+import urllib.request
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from . import db_utils
+from .search_types import TypeMap
+from .task_store import TaskStore
+
+# The requests come from the network: every argument is checked before it reaches TaskStore,
+# which formats the column names into the SQL, and a shared token can be required.
+
+TOKEN_HEADER = "X-TuneTools-Token"
+_COLUMN = re.compile(r"(param|ret|cost)_\w+")
+_RESULT_COLUMNS = ["STATUS", "DURATION_MIN"]
+_RESOURCE = re.compile(r"\w+")
+_LOOPBACK = ("localhost", "::1")
+
+
+def _is_int(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def _is_number(x):
+    return isinstance(x, numbers.Real) and not isinstance(x, bool)
+
+
+def _check(condition, what):
+    if not condition:
+        raise ValueError("invalid " + what)
+
+
+def _check_column(name, prefixes=("param", "ret", "cost")):
+    _check(isinstance(name, str) and (name in _RESULT_COLUMNS or (
+        _COLUMN.fullmatch(name) is not None and name.split("_")[0] in prefixes)),
+           "column: %r" % name)
+
+
+def _check_owner(host, pid):
+    _check(isinstance(host, str), "host")
+    _check(_is_int(pid), "pid")
+
+
+def _check_ids(db_ids):
+    _check(isinstance(db_ids, list) and all(_is_int(x) for x in db_ids), "task ids")
+
+
+def _check_claim(columns, limit, host, pid, lease_ttl, capacity):
+    _check(isinstance(columns, list), "columns")
+    for x in columns:
+        _check_column(x, ("param",))
+    _check(_is_int(limit) and limit > 0, "limit")
+    _check_owner(host, pid)
+    _check(_is_number(lease_ttl), "lease_ttl")
+    _check(capacity is None or (isinstance(capacity, dict) and all(
+        _RESOURCE.fullmatch(k) is not None and _is_number(v) for k, v in capacity.items())),
+           "capacity")
+
+
+def _check_start(db_id, host, pid):
+    _check(_is_int(db_id), "task id")
+    _check_owner(host, pid)
+
+
+def _check_finish(db_id, put, new_columns, host, pid):
+    _check_start(db_id, host, pid)
+    _check(isinstance(put, dict), "put")
+    for k, v in put.items():
+        _check_column(k)
+        _check(v is None or isinstance(v, (str, int, float)), "value of " + k)
+    _check(put.get("STATUS") in ("TERMINATED", "PRUNED"), "status")
+    db_types = [x.db_type for x in TypeMap.values()]
+    _check(isinstance(new_columns, list), "new columns")
+    for x in new_columns:
+        _check(isinstance(x, list) and len(x) == 3, "new column: %r" % x)
+        _check_column(x[0], ("ret",))
+        _check(x[1] in db_types and x[2] is None, "new column: %r" % x)
+
+
+def _check_reset(db_ids, host, pid):
+    _check_ids(db_ids)
+    _check_owner(host, pid)
+
+
+def _check_renew(db_ids, lease_ttl, host, pid):
+    _check_ids(db_ids)
+    _check(_is_number(lease_ttl), "lease_ttl")
+    _check_owner(host, pid)
+
+
+def _check_rung(db_id, rung, value, direction, reduction_factor):
+    _check(_is_int(db_id) and _is_int(rung), "task id or rung")
+    _check(_is_number(value), "value")
+    _check(direction in ("min", "max"), "direction")
+    _check(_is_number(reduction_factor) and reduction_factor >= 2, "reduction_factor")
+
+
+def _check_add_metrics(db_id, rows):
+    _check(_is_int(db_id), "task id")
+    _check(isinstance(rows, list) and all(
+        isinstance(x, list) and len(x) == 3 and _is_int(x[0]) and isinstance(x[1], str)
+        and _is_number(x[2]) for x in rows), "metrics")
+
+
+def _check_none():
+    pass
+
+
+_OPERATIONS = {
+    "claim": _check_claim,
+    "start": _check_start,
+    "finish": _check_finish,
+    "reset": _check_reset,
+    "requeue": _check_owner,
+    "renew": _check_renew,
+    "rung": _check_rung,
+    "add_metrics": _check_add_metrics,
+    "count_by_status": _check_none,
+    "count_reclaims": _check_none
+}
+
+
+class ServerClient:
+    # stands in for TaskStore on a node that pulls its tasks from `tunetools serve`
+
+    def __init__(self, address: str, timeout: float = 60, token: str = None):
+        self.url = "http://%s/" % address
+        self.timeout = timeout
+        self.token = token
+
+    def _call(self, op, *args):
+        headers = {"Content-Type": "application/json"}
+        if self.token is not None:
+            headers[TOKEN_HEADER] = self.token
+        request = urllib.request.Request(self.url + op, data=json.dumps(args).encode("utf-8"),
+                                         headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                reply = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            # a rejected request still carries the error of the coordinator
+            reply = json.loads(e.read().decode("utf-8"))
+        if "error" in reply:
+            raise RuntimeError("Coordinator error: " + reply["error"])
+        return reply["result"]
+
+    def _owner(self, host, pid):
+        # the operations run in another process, which must not fill in its own host and pid
+        return (host if host is not None else socket.gethostname(),
+                pid if pid is not None else os.getpid())
+
+    def claim(self, columns: list, limit: int = 1, host: str = None, pid: int = None,
+              lease_ttl: float = 0, capacity: dict = None):
+        return self._call("claim", columns, limit, *self._owner(host, pid), lease_ttl, capacity)
+
+    def start(self, db_id: int, host: str = None, pid: int = None):
+        return self._call("start", db_id, *self._owner(host, pid))
+
+    def finish(self, db_id: int, put: dict, new_columns: list, host: str = None, pid: int = None):
+        return self._call("finish", db_id, put, new_columns, *self._owner(host, pid))
+
+    def reset(self, db_ids: list, host: str = None, pid: int = None):
+        return self._call("reset", db_ids, *self._owner(host, pid))
+
+    def requeue(self, host: str, pid: int):
+        return self._call("requeue", host, pid)
+
+    def renew(self, db_ids: list, lease_ttl: float, host: str = None, pid: int = None):
+        return self._call("renew", db_ids, lease_ttl, *self._owner(host, pid))
+
+    def rung(self, db_id: int, rung: int, value: float, direction: str, reduction_factor: int):
+        return self._call("rung", db_id, rung, value, direction, reduction_factor)
+
+    def add_metrics(self, db_id: int, rows: list):
+        return self._call("add_metrics", db_id, rows)
+
+    def count_by_status(self):
+        return self._call("count_by_status")
+
+    def count_reclaims(self):
+        return self._call("count_reclaims")
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        op = self.path.strip("/")
+        length = int(self.headers.get("Content-Length", 0))
+        code = 200
+        try:
+            token = self.server.token
+            if token is not None and not hmac.compare_digest(
+                    self.headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8")):
+                code = 403
+                raise PermissionError("missing or wrong token")
+            if op not in _OPERATIONS:
+                raise ValueError("unknown operation: " + op)
+            args = json.loads(self.rfile.read(length).decode("utf-8") or "[]")
+            if not isinstance(args, list):
+                raise ValueError("the arguments must be a list")
+            try:
+                _OPERATIONS[op](*args)
+            except TypeError:
+                raise ValueError("wrong number of arguments for " + op)
+            reply = {"result": getattr(self.server.store, op)(*args)}
+        except Exception as e:
+            reply = {"error": "%s: %s" % (type(e).__name__, e)}
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(db_path: str, host: str, port: int, suggester=None, token: str = None):
+    # the returned server uses its connection from the thread that created it
+    httpd = HTTPServer((host, port), _Handler)
+    httpd.store = TaskStore(db_utils.connect(db_path), suggester)
+    httpd.token = token
+    return httpd
+
+
+def serve(db_path: str, host: str, port: int, suggester=None, token: str = None):
+    # Requests are handled one at a time, and this process is the only writer of the
+    # database, so the nodes never rely on file locking.
+    httpd = make_server(db_path, host, port, suggester, token)
+    print("Serving %s on %s:%d" % (db_path, host, httpd.server_address[1]))
+    if token is None and not (host in _LOOPBACK or host.startswith("127.")):
+        print("Warning: any host that reaches %s:%d can change the study, start the "
+              "coordinator with --token (or $TUNETOOLS_TOKEN) to require a shared token."
+              % (host, httpd.server_address[1]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        db_utils.flush_journal()
+        httpd.store.conn.close()
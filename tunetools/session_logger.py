@@ -1,35 +1,242 @@
-import sys, os, shutil
+import sys, os, shutil, gzip, threading, time, contextvars
 
+from . import config
 
-class RedirectLogger:
 
-    def __init__(self, path, std_out):
+class LogFile:
+
+    def __init__(self, path):
         self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.last_flush = time.time()
+        _flusher.add(self)
+
+    def write(self, data: bytes):
+        with self.lock:
+            if self.file is None:
+                return
+            if 0 < config._log_max_bytes <= self.size:
+                self._rotate()
+            self.file.write(data)
+            self.size += len(data)
+            if b"\n" in data and time.time() - self.last_flush >= config._log_flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self._flush()
+
+    def close(self):
+        _flusher.discard(self)
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _flush(self):
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(config._log_backup_count - 1, 0, -1):
+            if os.path.isfile("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if config._log_backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        self.file = open(self.path, "wb")
+        self.size = 0
+
+    def backups(self):
+        return [x for x in ("%s.%d" % (self.path, i) for i in range(1, config._log_backup_count + 1))
+                if os.path.isfile(x)]
+
+
+class _Flusher:
+    # flushes the open logs every _log_flush_interval seconds, so that the output before a long
+    # silent phase (or a kill -9) reaches the file and `tunetools status` shows it
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log_files = set()
+        self.thread = None
+
+    def add(self, log_file):
+        with self.lock:
+            self.log_files.add(log_file)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_periodically, daemon=True)
+                self.thread.start()
+
+    def discard(self, log_file):
+        with self.lock:
+            self.log_files.discard(log_file)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(config._log_flush_interval)
+            with self.lock:
+                log_files = list(self.log_files)
+            for log_file in log_files:
+                log_file.flush()
+
+    def _after_fork(self):
+        # the logs of the parent are not written by the child
+        self.lock = threading.Lock()
+        self.log_files = set()
+        self.thread = None
+
+
+_flusher = _Flusher()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_flusher._after_fork)
+
+
+class RedirectLogger:
+
+    def __init__(self, log_file, std_out):
+        self.log_file = log_file
+        self.path = log_file.path
+        self.stdout = std_out
+
+    def write(self, string):
+        self.stdout.write(string)
+        self.log_file.write(string.encode("utf-8", "replace"))
+
+    def flush(self):
+        self.stdout.flush()
+        self.log_file.flush()
+
+
+class ContextRedirectLogger:
+    # writes to the log of the trial running in the current context (e.g. an asyncio task)
+
+    def __init__(self, std_out):
         self.stdout = std_out
 
     def write(self, string):
         self.stdout.write(string)
-        with open(self.path, 'a') as f:
-            f.write(string)
+        log_file = _context_log_file.get()
+        if log_file is not None:
+            log_file.write(string.encode("utf-8", "replace"))
 
     def flush(self):
         self.stdout.flush()
+        log_file = _context_log_file.get()
+        if log_file is not None:
+            log_file.flush()
+
+
+class FdTee:
+    # captures everything written to a file descriptor, including the output of
+    # subprocesses and C extensions, and copies it to the original target and the log
+
+    def __init__(self, fd, log_file):
+        self.fd = fd
+        self.log_file = log_file
+        self.saved_fd = os.dup(fd)
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        self.thread = threading.Thread(target=self._pump, args=(read_fd,), daemon=True)
+        self.thread.start()
+
+    def _pump(self, read_fd):
+        while True:
+            data = os.read(read_fd, 65536)
+            if len(data) == 0:
+                break
+            os.write(self.saved_fd, data)
+            self.log_file.write(data)
+        os.close(read_fd)
+
+    def close(self):
+        os.dup2(self.saved_fd, self.fd)
+        # a subprocess that is still alive may keep the pipe open
+        self.thread.join(timeout=5)
+        os.close(self.saved_fd)
+
+
+_log_file = None
+_fd_tees = []
+_context_log_file = contextvars.ContextVar("tunetools_log_file", default=None)
+
+
+def _can_capture_fd():
+    try:
+        return sys.stdout.fileno() == 1 and sys.stderr.fileno() == 2
+    except (AttributeError, ValueError, OSError):
+        return False
 
 
 def _start(run_id):
+    global _log_file, _fd_tees
     dir_path = os.path.join(".tune", "logs")
     path = os.path.join(dir_path, str(run_id) + ".log")
     if not os.path.isdir(dir_path):
         os.makedirs(dir_path)
-    if not os.path.isfile(path):
-        open(path, mode="w").close()
-    sys.stdout = RedirectLogger(path, sys.stdout)
-    sys.stderr = RedirectLogger(path, sys.stderr)
+    _log_file = LogFile(path)
+    if config._log_capture == "fd" and _can_capture_fd():
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _fd_tees = [FdTee(1, _log_file), FdTee(2, _log_file)]
+    else:
+        sys.stdout = RedirectLogger(_log_file, sys.stdout)
+        sys.stderr = RedirectLogger(_log_file, sys.stderr)
 
 
 def _end(should_remove_file):
+    global _log_file, _fd_tees
+    if _log_file is None:
+        return
+    if len(_fd_tees) != 0:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for tee in _fd_tees:
+            tee.close()
+        _fd_tees = []
     if type(sys.stdout) == RedirectLogger:
+        sys.stdout = sys.stdout.stdout
+        sys.stderr = sys.stderr.stdout
+    _close(_log_file, should_remove_file)
+    _log_file = None
+
+
+def _close(log_file, should_remove_file):
+    log_file.close()
+    paths = [log_file.path] + log_file.backups()
+    for path in paths:
         if should_remove_file:
-            os.remove(sys.stdout.path)
+            os.remove(path)
+        elif config._log_compress:
+            # appended as another gzip member: an earlier attempt of the trial keeps its log
+            with open(path, "rb") as f_in, gzip.open(path + ".gz", "ab") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(path)
+
+
+def _install_context():
+    sys.stdout = ContextRedirectLogger(sys.stdout)
+    sys.stderr = ContextRedirectLogger(sys.stderr)
+
+
+def _uninstall_context():
+    if type(sys.stdout) == ContextRedirectLogger:
         sys.stdout = sys.stdout.stdout
         sys.stderr = sys.stderr.stdout
+
+
+def _start_context(run_id):
+    dir_path = os.path.join(".tune", "logs")
+    os.makedirs(dir_path, exist_ok=True)
+    log_file = LogFile(os.path.join(dir_path, str(run_id) + ".log"))
+    _context_log_file.set(log_file)
+    return log_file
+
+
+def _end_context(log_file, should_remove_file):
+    _context_log_file.set(None)
+    _close(log_file, should_remove_file)
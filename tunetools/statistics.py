@@ -1,4 +1,5 @@
 import yaml
+from tunetools import aggregate as aggregate_table
 from tunetools import db_utils
 import numpy as np
 import pandas as pd
@@ -25,7 +26,7 @@ def _check_param(param, total_param, mark_param: set):
     return new_param
 
 
-def _parse(conn, yaml_path, formatter, csv: bool):
+def _parse(conn, yaml_path, formatter, csv: bool, aggregate: bool = False):
     yml_dict = yaml.load(open(yaml_path), Loader=yaml.FullLoader)
 
     total_params = [x[6:] for x in db_utils.get_columns(conn, "RESULT") if x.startswith("param_")]
@@ -60,68 +61,54 @@ def _parse(conn, yaml_path, formatter, csv: bool):
             where_clause_params.append(item[1])
         elif type(where_condition) == str:
             where_clauses.append(where_condition)
+    if aggregate:
+        # the AGGREGATE table only counts the TERMINATED tasks
+        where_clauses = where_clauses[1:]
     where_clauses_statement = " AND ".join(list(map(lambda x: "(%s)" % x, where_clauses)))
 
-    statement = "SELECT * FROM RESULT"
-    if len(where_clauses) != 0:
-        statement += " WHERE " + where_clauses_statement
-    cursor = db_utils.execute_sql(conn, statement, where_clause_params)
-    columns = [description[0] for description in cursor.description]
-    result = list(cursor)
-
-    data = pd.DataFrame(result, columns=columns)  # (group_by, find_best, num_sample) -> result
-
-    def apply_find_best(df: pd.DataFrame):
-        # input: (**group_by**, find_best, num_sample) -> result
-        # output: (**group_by**) -> best ArrayWrapper
-        agg = df.groupby(by=["param_" + x for x in find_best_params], as_index=False).apply(
-            apply_aggregate_sample)
-        # agg: (**group_by**, **find_best**) -> ArrayWrapper
-        best_row = None
-        for _, row in agg.iterrows():
-            if best_row is None:
-                best_row = row
-            else:
-                for ret_name, direction in target_result.items():
-                    if direction != 'max' and direction != 'min':
-                        continue
-                    larger = row['ret_' + ret_name].mean() > best_row['ret_' + ret_name].mean()
-                    lower = row['ret_' + ret_name].mean() < best_row['ret_' + ret_name].mean()
-                    is_better = (direction == 'max' and larger) or (direction == 'min' and lower)
-                    is_worse = (direction == 'max' and lower) or (direction == 'min' and larger)
-                    if is_better:
-                        best_row = row
-                        break
-                    if is_worse:
-                        break
-        return best_row
-
-    def apply_aggregate_sample(df: pd.DataFrame):
-        # input: (**group_by**, **find_best**, num_sample) -> result
-        # output: (**group_by**, **find_best**) -> ArrayWrapper
-        current_group = dict(
-            ('param_' + g, df['param_' + g].iloc[0]) for g in (group_by_params + find_best_params))
-
-        for p in left_params:
-            if p in ignore_params:
-                continue
-            flatten_set = set(df['param_' + p])
-            if len(flatten_set) != 1:
-                raise ValueError("Identifiability check failed: there exist distinct values " + str(
-                    flatten_set) +
-                                 " on parameter '" + p + "' in group: " + str(current_group) +
-                                 ", which may make the aggregated target inaccurate. " +
-                                 "Please check it. You can add '" + p +
-                                 "' into 'find_best', 'group_by' or 'ignore' configurations, or filter "
-                                 "this case in 'where' configurations.")
-
-        current_group.update(
-            dict(('ret_' + g, ArrayWrapper(list(df['ret_' + g]), formatter)) for g in target_result))
-        x = pd.Series(current_group)
-        return x
-
-    data = data.groupby(by=["param_" + x for x in group_by_params], as_index=False).apply(
-        apply_find_best)
+    keys = list(dict.fromkeys("param_" + x for x in current_params))
+    check_columns = ["param_" + p for p in left_params if p not in ignore_params]
+    param_columns = ["param_" + x for x in total_params]
+    if aggregate:
+        if yml_dict.get("t_test", None) is not None:
+            raise ValueError("t_test needs every sample, please run statistics without --aggregate.")
+        if not aggregate_table.enabled(conn):
+            raise ValueError("No AGGREGATE table, please run the experiment with --aggregate.")
+        # (params) -> count, sum and sum of squares of each target
+        statement = "SELECT %s FROM AGGREGATE" % ", ".join(param_columns + [
+            "SUM(CASE WHEN NAME = ? THEN %s END)" % x for _ in target_result
+            for x in ["COUNT", "SUM", "SUMSQ"]])
+        statement_params = [x for x in target_result for _ in range(3)]
+        if len(where_clauses) != 0:
+            statement += " WHERE " + where_clauses_statement
+        statement += " GROUP BY " + ", ".join(param_columns)
+        cursor = db_utils.execute_sql(conn, statement, statement_params + where_clause_params)
+        data = pd.DataFrame(list(cursor), columns=param_columns + [
+            "%s_%s" % (x, g) for g in target_result for x in ["count", "sum", "sumsq"]])
+
+        # (**group_by**, **find_best**) -> ArrayWrapper
+        agg = _aggregate_sums(data, keys, check_columns, list(target_result), formatter)
+    else:
+        # only the columns the aggregation reads
+        statement = "SELECT %s FROM RESULT" % ", ".join(
+            param_columns + ["ret_" + x for x in target_result])
+        if len(where_clauses) != 0:
+            statement += " WHERE " + where_clauses_statement
+        cursor = db_utils.execute_sql(conn, statement, where_clause_params)
+        columns = [description[0] for description in cursor.description]
+        result = list(cursor)
+
+        data = pd.DataFrame(result, columns=columns)  # (group_by, find_best, num_sample) -> result
+
+        # (**group_by**, **find_best**) -> ArrayWrapper
+        agg = _aggregate_samples(data, keys, check_columns, ["ret_" + g for g in target_result],
+                                 formatter)
+    # (**group_by**) -> best ArrayWrapper
+    group_codes = agg.groupby(by=["param_" + x for x in group_by_params], sort=True).ngroup()
+    best = _find_best(group_codes.to_numpy(), [
+        (agg['ret_' + ret_name], direction) for ret_name, direction in target_result.items()
+        if direction == 'max' or direction == 'min'])
+    data = agg.iloc[best]
     data.index = range(len(data))
 
     # t-test
@@ -137,6 +124,103 @@ def _parse(conn, yaml_path, formatter, csv: bool):
         draw(data, draw_params)
 
 
+def _group(data: pd.DataFrame, keys: list, check_columns: list):
+    # Groups the rows by the keys, in sorted order, and checks that the check columns have a
+    # single value in each group. Returns the groups, the row positions sorted by group (keeping
+    # their order in `data`), and the size and the first position of each group in them.
+    grouped = data.groupby(by=keys, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]  # rows with a NULL key belong to no group
+    sizes = np.bincount(codes[order], minlength=grouped.ngroups)
+    starts = np.cumsum(sizes) - sizes
+
+    if len(check_columns) != 0:
+        distinct = grouped[check_columns].nunique(dropna=False).to_numpy()
+        if (distinct > 1).any():
+            i, j = np.argwhere(distinct > 1)[0]
+            rows = data.iloc[order[starts[i]:starts[i] + sizes[i]]]
+            current_group = dict((k, rows[k].iloc[0]) for k in keys)
+            p = check_columns[j][6:]
+            raise ValueError("Identifiability check failed: there exist distinct values " + str(
+                set(rows['param_' + p])) +
+                             " on parameter '" + p + "' in group: " + str(current_group) +
+                             ", which may make the aggregated target inaccurate. " +
+                             "Please check it. You can add '" + p +
+                             "' into 'find_best', 'group_by' or 'ignore' configurations, or filter "
+                             "this case in 'where' configurations.")
+    return grouped, order, sizes, starts
+
+
+def _aggregate_samples(data: pd.DataFrame, keys: list, check_columns: list, ret_columns: list,
+                       formatter: str):
+    # One row per distinct keys, in sorted order: the keys, then an ArrayWrapper of the samples of
+    # each ret column. The samples keep their order in `data`.
+    grouped, order, sizes, starts = _group(data, keys, check_columns)
+    agg = data[keys].iloc[order[starts]].reset_index(drop=True)
+    for column in ret_columns:
+        values = data[column].to_numpy()
+        samples = np.split(values[order], starts[1:]) if len(sizes) != 0 else []
+        if values.dtype.kind not in "biuf":
+            agg[column] = [ArrayWrapper(list(x), formatter) for x in samples]
+            continue
+        mean = _sequential_sum(values[order].astype(float), starts, sizes) / sizes
+        agg[column] = [ArrayWrapper(x, formatter, m) for x, m in zip(samples, mean)]
+    return agg
+
+
+def _aggregate_sums(data: pd.DataFrame, keys: list, check_columns: list, targets: list,
+                    formatter: str):
+    # the same as _aggregate_samples, from the count_<target>, sum_<target> and sumsq_<target>
+    # columns of the configurations
+    grouped, order, sizes, starts = _group(data, keys, check_columns)
+    agg = data[keys].iloc[order[starts]].reset_index(drop=True)
+    sums = grouped[[c for c in data.columns if not c.startswith("param_")]].sum(min_count=1)
+    for target in targets:
+        agg["ret_" + target] = [
+            ArrayWrapper.from_sums(n, total, total_sq, formatter) for n, total, total_sq in zip(
+                sums["count_" + target], sums["sum_" + target], sums["sumsq_" + target])]
+    return agg
+
+
+def _sequential_sum(values: np.ndarray, starts: np.ndarray, sizes: np.ndarray):
+    # Sums every group from left to right, one sample position at a time over all the groups.
+    # Unlike the pairwise or compensated sums of numpy and pandas, this is exactly sum() of
+    # each group, so that ties between the means and the printed digits do not change.
+    sums = np.zeros(len(sizes))
+    for k in range(sizes.max(initial=0)):
+        active = np.flatnonzero(sizes > k)
+        sums[active] += values[starts[active] + k]
+    return sums
+
+
+def _find_best(group_codes: np.ndarray, targets: list):
+    # Positions of the best row of each group, in group order. targets: [(ArrayWrapper column,
+    # 'min' / 'max')] compared by mean, one after the other on ties; the first row wins ties.
+    keys = [np.array([x.mean() for x in column], dtype=float) * (1 if direction == 'min' else -1)
+            for column, direction in targets]
+    position = np.arange(len(group_codes))
+    if len(group_codes) == 0:
+        return position
+    if not any(np.isnan(x).any() for x in keys):
+        order = np.lexsort([position] + keys[::-1] + [group_codes])
+        first = np.concatenate([[True], group_codes[order][1:] != group_codes[order][:-1]])
+        return order[first]
+    # a NaN mean is neither better nor worse: compare row by row
+    best = {}
+    for i, code in enumerate(group_codes):
+        if code not in best:
+            best[code] = i
+            continue
+        for key in keys:
+            if key[i] < key[best[code]]:
+                best[code] = i
+                break
+            if key[i] > key[best[code]]:
+                break
+    return np.array([best[x] for x in sorted(best)], dtype=int)
+
+
 def print_group(data: pd.DataFrame, mark_params, csv: bool):
     group = data.copy()
     mark_params = ["param_" + x for x in mark_params]
@@ -254,18 +338,32 @@ def draw_with_json(content, from_statistics=False):
 
 
 class ArrayWrapper:
-    def __init__(self, content, formatter: str):
+    # the samples of a target; the mean can be given when computed for many groups at once
+    def __init__(self, content, formatter: str, mean=None):
         try:
-            self._array = list(map(float, content))
+            if isinstance(content, np.ndarray) and content.dtype.kind in "biuf":
+                self._array = content.astype(float)
+            else:
+                self._array = np.array(list(map(float, content)), dtype=float)
             self._formatter = formatter
             self._is_numeric = True
         except Exception:
             self._array = content
             self._is_numeric = False
-        self._mean = None
+        self._mean = mean
         self._std = None
+        self._count = None
         self._p_value = None
 
+    @staticmethod
+    def from_sums(count, total, total_sq, formatter: str):
+        # the target of a configuration known by its count, sum and sum of squares, without samples
+        x = ArrayWrapper([], formatter)
+        x._count = 0 if np.isnan(count) else int(count)
+        x._mean = total / count if x._count != 0 else np.nan
+        x._std = np.sqrt(max(total_sq / count - x._mean ** 2, 0)) if x._count != 0 else np.nan
+        return x
+
     def __repr__(self):
         if self._is_numeric:
             content = self._formatter.format(count=self.count(), mean=self.mean(), std=self.std())
@@ -298,6 +396,8 @@ class ArrayWrapper:
         return self._p_value
 
     def count(self):
+        if self._count is not None:
+            return self._count
         return len(self._array)
 
     def __str__(self):
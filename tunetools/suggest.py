@@ -0,0 +1,162 @@
+import os
+import random
+import socket
+import sqlite3
+
+import numpy as np
+
+from . import db_utils
+from .core import _SHUFFLE_KEY_RANGE
+from .search_space import *
+
+
+class TPESuggester:
+    # Adaptive search with a tree-structured Parzen estimator. Whenever a worker finds no
+    # pending task, the claim transaction calls refill(), which inserts the next configuration
+    # until `budget` configurations exist. The finished tasks are split into the best `gamma`
+    # fraction (at most 25) of ret_<target> and the rest; among candidates drawn around the good
+    # ones, the one maximizing l(x) / g(x) is chosen. Before `n_startup` results exist, it samples
+    # uniformly at random.
+
+    def __init__(self, parameters: list, target: str, direction: str = "min", budget: int = 100,
+                 seed: int = 0, num_sample: int = 1, filter_function=None,
+                 vectorized_filter: bool = False, n_startup: int = 10, n_candidates: int = 24,
+                 gamma: float = 0.1):
+        if direction not in ("min", "max"):
+            raise ValueError("direction must be 'min' or 'max', but found: " + str(direction))
+        self.parameters = parameters
+        self.target = target
+        self.direction = direction
+        self.budget = budget
+        self.seed = seed
+        self.num_sample = num_sample
+        self.filter_function = filter_function
+        self.vectorized_filter = vectorized_filter
+        self.n_startup = n_startup
+        self.n_candidates = n_candidates
+        self.gamma = gamma
+
+    def refill(self, conn: sqlite3.Connection):
+        # called under the write lock of a claim: returns the number of inserted tasks
+        if db_utils.select_first(conn, "RESULT", ["ID"], where={"STATUS": "PENDING"}) is not None:
+            return 0
+        total = db_utils.count(conn, "RESULT")
+        if total >= self.budget * self.num_sample:
+            return 0
+        rng = np.random.default_rng([self.seed, total])
+        values = self.suggest(*self._observations(conn), rng)
+        if values is None:
+            return 0
+        columns = ["HOST", "PID", "SHUFFLE_KEY"] + [x.db_name for x in self.parameters]
+        rows = [[socket.gethostname(), os.getpid(), random.randrange(_SHUFFLE_KEY_RANGE)]
+                + list(values) for _ in range(self.num_sample)]
+        return db_utils.insert_many(conn, "RESULT", columns, rows)
+
+    def _observations(self, conn):
+        column = "ret_" + self.target
+        if column not in db_utils.get_columns(conn, "RESULT"):
+            return [], []
+        cursor = db_utils.execute_sql(conn, "SELECT %s FROM RESULT WHERE STATUS = 'TERMINATED' "
+                                            "AND %s IS NOT NULL" % (
+                                                ", ".join([x.db_name for x in self.parameters]
+                                                          + [column]), column))
+        rows = list(cursor)
+        return [x[:-1] for x in rows], [x[-1] for x in rows]
+
+    def suggest(self, points: list, values: list, rng):
+        # returns the parameter values of the next configuration, or None if every candidate
+        # is filtered out
+        for _ in range(10):
+            if len(values) < self.n_startup:
+                candidates = [tuple(x.from_unit(u) for x, u in zip(self.parameters, point))
+                              for point in rng.random((self.n_candidates, len(self.parameters)))]
+                scores = np.zeros(len(candidates))
+            else:
+                candidates, scores = self._candidates(points, values, rng)
+            allowed = self._allowed(candidates)
+            if allowed.any():
+                scores = np.where(allowed, scores, -np.inf)
+                return candidates[int(np.argmax(scores))]
+        return None
+
+    def _candidates(self, points, values, rng):
+        order = np.argsort(values, kind="stable")
+        if self.direction == "max":
+            order = order[::-1]
+        n_good = min(int(np.ceil(self.gamma * len(values))), 25)
+        good, bad = order[:n_good], order[n_good:]
+
+        columns = []
+        scores = np.zeros(self.n_candidates)
+        for i, x in enumerate(self.parameters):
+            observed = [p[i] for p in points]
+            if isinstance(x, UniformSearchSpace):
+                units = np.array([x.to_unit(v) for v in observed])
+                sampled = _sample_parzen(units[good], self.n_candidates, rng)
+                scores += (np.log(_parzen_density(sampled, units[good]))
+                           - np.log(_parzen_density(sampled, units[bad])))
+                columns.append([x.from_unit(u) for u in sampled])
+            else:
+                domain = x.sample()
+                index = dict((x.base_type.python_type(v), k) for k, v in enumerate(domain))
+                indices = np.array([index.get(x.base_type.python_type(v), -1)
+                                    if v is not None else -1 for v in observed])
+                l = _categorical_prior(indices[good], len(domain))
+                g = _categorical_prior(indices[bad], len(domain))
+                sampled = rng.choice(len(domain), size=self.n_candidates, p=l)
+                scores += np.log(l[sampled]) - np.log(g[sampled])
+                columns.append([domain[k] for k in sampled])
+        return list(zip(*columns)), scores
+
+    def _allowed(self, candidates):
+        if self.filter_function is None or len(self.parameters) == 0:
+            return np.ones(len(candidates), dtype=bool)
+        configs = [dict((x.name, x.base_type.python_type(v)) for x, v in zip(self.parameters, c))
+                   for c in candidates]
+        if self.vectorized_filter:
+            batch = dict((x.name, np.array([c[x.name] for c in configs])) for x in self.parameters)
+            return np.broadcast_to(np.asarray(self.filter_function(**batch), dtype=bool),
+                                   (len(candidates),))
+        return np.array([bool(self.filter_function(**c)) for c in configs], dtype=bool)
+
+
+def _parzen(centers):
+    # A gaussian per center, with the distance to its farthest neighbor as bandwidth, and a
+    # wide prior component. Returns (means, sigmas), truncated to [0, 1].
+    means = np.append(centers, 0.5)
+    if len(centers) == 0:
+        return means, np.ones(1)
+    order = np.argsort(centers)
+    padded = np.concatenate([[0], centers[order], [1]])
+    gaps = np.maximum(padded[1:-1] - padded[:-2], padded[2:] - padded[1:-1])
+    sigmas = np.empty(len(centers))
+    sigmas[order] = np.clip(gaps, 1 / min(100, len(centers) + 1), 1)
+    return means, np.append(sigmas, 1)
+
+
+def _sample_parzen(centers, n, rng):
+    means, sigmas = _parzen(centers)
+    component = rng.integers(0, len(means), size=n)
+    sampled = rng.normal(means[component], sigmas[component])
+    # redraw the samples outside of [0, 1)
+    for _ in range(100):
+        outside = (sampled < 0) | (sampled >= 1)
+        if not outside.any():
+            break
+        sampled[outside] = rng.normal(means[component[outside]], sigmas[component[outside]])
+    return np.clip(sampled, 0, np.nextafter(1, 0))
+
+
+def _parzen_density(x, centers):
+    from scipy.special import ndtr
+    means, sigmas = _parzen(centers)
+    z = (x[:, None] - means[None, :]) / sigmas[None, :]
+    mass = ndtr((1 - means) / sigmas) - ndtr(-means / sigmas)
+    gaussians = np.exp(-0.5 * z ** 2) / (sigmas * np.sqrt(2 * np.pi) * mass)[None, :]
+    return gaussians.mean(axis=1)
+
+
+def _categorical_prior(indices, size):
+    # smoothed frequencies of the observed domain indices (-1 is an unknown value)
+    counts = np.bincount(indices[indices >= 0], minlength=size).astype(float) + 1
+    return counts / counts.sum()
@@ -0,0 +1,192 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+from . import aggregate
+from . import db_utils
+from . import scheduler
+
+
+class TaskStore:
+    # The RESULT operations of a worker. Each public method runs in its own transaction,
+    # while the group-commit writer composes the underscored ones into one transaction.
+
+    def __init__(self, conn: sqlite3.Connection, suggester=None):
+        self.conn = conn
+        # adds the next configuration of an adaptive search when no task is pending
+        self.suggester = suggester
+
+    def claim(self, columns: list, limit: int = 1, host: str = None, pid: int = None,
+              lease_ttl: float = 0, capacity: dict = None):
+        with db_utils.immediate_transaction(self.conn):
+            return self._claim(columns, limit, host, pid, lease_ttl, capacity)
+
+    def start(self, db_id: int, host: str = None, pid: int = None):
+        with db_utils.immediate_transaction(self.conn):
+            return self._start(db_id, host, pid)
+
+    def finish(self, db_id: int, put: dict, new_columns: list, host: str = None, pid: int = None):
+        with db_utils.immediate_transaction(self.conn):
+            return self._finish(db_id, put, new_columns, host, pid)
+
+    def reset(self, db_ids: list, host: str = None, pid: int = None):
+        with db_utils.immediate_transaction(self.conn):
+            return self._reset(db_ids, host, pid)
+
+    def requeue(self, host: str, pid: int):
+        # give back the tasks held by a dead worker process
+        with db_utils.immediate_transaction(self.conn):
+            return db_utils.update(self.conn, "RESULT", put={"STATUS": "PENDING"},
+                                   where={"STATUS": "RUNNING", "HOST": host, "PID": pid}).rowcount
+
+    def renew(self, db_ids: list, lease_ttl: float, host: str = None, pid: int = None):
+        with db_utils.immediate_transaction(self.conn):
+            return self._renew(db_ids, lease_ttl, host, pid)
+
+    def rung(self, db_id: int, rung: int, value: float, direction: str, reduction_factor: int):
+        # records the metric of a trial at a rung, and returns whether the trial continues
+        with db_utils.immediate_transaction(self.conn):
+            return self._rung(db_id, rung, value, direction, reduction_factor)
+
+    def add_metrics(self, db_id: int, rows: list):
+        with db_utils.immediate_transaction(self.conn):
+            return self._add_metrics(db_id, rows)
+
+    def count_by_status(self):
+        return self._count_by_status()
+
+    def count_reclaims(self):
+        return self._count_reclaims()
+
+    def _claim(self, columns, limit, host, pid, lease_ttl=0, capacity=None):
+        host = host if host is not None else socket.gethostname()
+        now = int(time.time())
+        # take back the tasks of the workers that stopped renewing their lease (killed, out of
+        # memory, node lost) before handing out new ones
+        db_utils.execute_sql(self.conn, "UPDATE RESULT SET STATUS = 'PENDING', "
+                                        "RECLAIMS = COALESCE(RECLAIMS, 0) + 1 "
+                                        "WHERE STATUS = 'RUNNING' AND LEASE_UNTIL < ?", [now])
+        if self.suggester is not None:
+            self.suggester.refill(self.conn)
+        where = "STATUS = 'PENDING'"
+        if capacity is not None:
+            where = scheduler.claim_where(self.conn, capacity, host)
+            # the free capacity is only checked against one task at a time
+            limit = 1
+        # the literal STATUS = 'PENDING' lets SQLite walk IDX_RESULT_PENDING instead of sorting
+        # (by the PRIORITY set by scheduler.rank, then randomly)
+        return db_utils.claim(self.conn, "RESULT",
+                              project=["ID"] + list(columns),
+                              put={
+                                  "HOST": host,
+                                  "PID": pid if pid is not None else os.getpid(),
+                                  "STATUS": "RUNNING",
+                                  "RUN_AT": now,
+                                  "LEASE_UNTIL": now + int(lease_ttl) if lease_ttl > 0 else None
+                              },
+                              where=where,
+                              order_by="PRIORITY, SHUFFLE_KEY",
+                              limit=limit)
+
+    def _owned(self, db_id, host, pid):
+        # A worker only updates the tasks it still runs: once its lease is reclaimed, the task
+        # may be RUNNING in another worker, whose result, lease and status must stay.
+        return {"ID": db_id, "STATUS": "RUNNING",
+                "HOST": host if host is not None else socket.gethostname(),
+                "PID": pid if pid is not None else os.getpid()}
+
+    def _start(self, db_id, host=None, pid=None):
+        # returns whether the task is still held, a batch-claimed task may be reclaimed first
+        return db_utils.update(self.conn, "RESULT", put={"RUN_AT": int(time.time())},
+                               where=self._owned(db_id, host, pid)).rowcount != 0
+
+    def _finish(self, db_id, put, new_columns, host=None, pid=None):
+        # returns whether the result is recorded, a stale finish is dropped
+        db_utils.ensure_column(self.conn, "RESULT", new_columns)
+        if db_utils.update(self.conn, "RESULT", put=put,
+                           where=self._owned(db_id, host, pid)).rowcount == 0:
+            return False
+        if put.get("STATUS") == "TERMINATED" and aggregate.enabled(self.conn):
+            aggregate.add(self.conn, db_id, dict((k[4:], v) for k, v in put.items()
+                                                 if k.startswith("ret_")))
+        return True
+
+    def _reset(self, db_ids, host=None, pid=None):
+        return sum(db_utils.update(self.conn, "RESULT", put={"STATUS": "PENDING"},
+                                   where=self._owned(db_id, host, pid)).rowcount
+                   for db_id in db_ids)
+
+    def _renew(self, db_ids, lease_ttl, host=None, pid=None):
+        owned = self._owned(None, host, pid)
+        db_utils.execute_sql(self.conn, "UPDATE RESULT SET LEASE_UNTIL = ? WHERE STATUS = 'RUNNING' "
+                                        "AND HOST = ? AND PID = ? AND ID IN (%s)" % ", ".join(
+                                            ["?"] * len(db_ids)),
+                             [int(time.time() + lease_ttl), owned["HOST"], owned["PID"]]
+                             + list(db_ids))
+
+    def _rung(self, db_id, rung, value, direction, reduction_factor):
+        db_utils.delete(self.conn, "RUNG", where={"TRIAL_ID": db_id, "RUNG": rung})
+        db_utils.insert(self.conn, "RUNG", [{"TRIAL_ID": db_id, "RUNG": rung, "VALUE": value}])
+        values = [x[0] for x in db_utils.select(self.conn, "RUNG", ["VALUE"], where={"RUNG": rung})]
+        return scheduler.promotable(value, values, direction, reduction_factor)
+
+    def _add_metrics(self, db_id, rows):
+        # rows: [(step, name, value)]
+        db_utils.execute_many(self.conn, "INSERT OR REPLACE INTO METRIC (TRIAL_ID, STEP, NAME, "
+                                         "VALUE) VALUES (?, ?, ?, ?)",
+                              [[db_id] + list(x) for x in rows])
+
+    def _count_by_status(self):
+        cursor = db_utils.execute_sql(self.conn, "SELECT STATUS, COUNT(*) FROM RESULT GROUP BY STATUS")
+        return dict(cursor)
+
+    def _count_reclaims(self):
+        if "RECLAIMS" not in db_utils.get_columns(self.conn, "RESULT"):
+            return 0
+        return db_utils.execute_sql_return_first(self.conn, "SELECT SUM(RECLAIMS) FROM RESULT")[0] or 0
+
+
+class Heartbeat:
+    # Renews the lease of the tasks held by a worker every lease_ttl / 3 seconds from a
+    # background thread. A lease_ttl of 0 disables the leases.
+
+    def __init__(self, open_store, lease_ttl: float):
+        self.open_store = open_store
+        self.lease_ttl = lease_ttl
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if lease_ttl > 0:
+            self.thread = threading.Thread(target=self._renew_periodically, daemon=True)
+            self.thread.start()
+
+    def hold(self, db_ids):
+        with self.lock:
+            self.held.update(db_ids)
+
+    def release(self, db_ids):
+        with self.lock:
+            self.held.difference_update(db_ids)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _renew_periodically(self):
+        store = self.open_store()
+        while not self.stopped.wait(self.lease_ttl / 3):
+            with self.lock:
+                db_ids = list(self.held)
+            if len(db_ids) == 0:
+                continue
+            try:
+                store.renew(db_ids, self.lease_ttl)
+            except Exception:
+                traceback.print_exc()
+        if isinstance(store, TaskStore):
+            store.conn.close()
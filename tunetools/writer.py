@@ -0,0 +1,133 @@
+import os
+import queue
+import socket
+import threading
+import time
+
+from . import db_utils
+from .task_store import TaskStore
+
+
+class WriterClient:
+    # stands in for TaskStore in a worker process, and forwards each operation to the writer
+
+    def __init__(self, worker_id: int, requests, responses):
+        self.worker_id = worker_id
+        self.requests = requests
+        self.responses = responses
+        self.count = 0
+        # the lease heartbeat thread calls the writer too
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _call(self, op, *args):
+        with self.lock:
+            self.count += 1
+            token = (os.getpid(), self.count)
+            self.requests.put((self.worker_id, token, op, args))
+            while True:
+                # skip the replies addressed to a crashed predecessor of this worker
+                reply_token, result = self.responses.get()
+                if reply_token == token:
+                    break
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _owner(self, host, pid):
+        # the operations run in another process, which must not fill in its own host and pid
+        return (host if host is not None else socket.gethostname(),
+                pid if pid is not None else os.getpid())
+
+    def claim(self, columns: list, limit: int = 1, host: str = None, pid: int = None,
+              lease_ttl: float = 0, capacity: dict = None):
+        return self._call("claim", columns, limit, *self._owner(host, pid), lease_ttl, capacity)
+
+    def start(self, db_id: int, host: str = None, pid: int = None):
+        return self._call("start", db_id, *self._owner(host, pid))
+
+    def finish(self, db_id: int, put: dict, new_columns: list, host: str = None, pid: int = None):
+        return self._call("finish", db_id, put, new_columns, *self._owner(host, pid))
+
+    def reset(self, db_ids: list, host: str = None, pid: int = None):
+        return self._call("reset", db_ids, *self._owner(host, pid))
+
+    def renew(self, db_ids: list, lease_ttl: float, host: str = None, pid: int = None):
+        return self._call("renew", db_ids, lease_ttl, *self._owner(host, pid))
+
+    def rung(self, db_id: int, rung: int, value: float, direction: str, reduction_factor: int):
+        return self._call("rung", db_id, rung, value, direction, reduction_factor)
+
+    def add_metrics(self, db_id: int, rows: list):
+        return self._call("add_metrics", db_id, rows)
+
+    def count_by_status(self):
+        return self._call("count_by_status")
+
+
+def stop(requests):
+    requests.put((None, None, "stop", ()))
+
+
+def serve(db_path: str, requests, responses: list, batch_size: int = 64,
+          max_latency: float = 0.01, report_interval: float = 10, suggester=None):
+    # Owns the database for all the workers: waits at most `max_latency` seconds to collect
+    # up to `batch_size` operations, then commits them in one transaction.
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = db_utils.connect(db_path)
+    store = TaskStore(conn, suggester)
+    total_commits, total_operations = 0, 0
+    commits, operations = 0, 0
+    last_report = time.time()
+    running = True
+
+    while running:
+        batch = [requests.get()]
+        deadline = time.time() + max_latency
+        while len(batch) < batch_size:
+            try:
+                batch.append(requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+
+        replies = []
+        with db_utils.immediate_transaction(conn):
+            for worker_id, token, op, args in batch:
+                if op == "stop":
+                    running = False
+                    continue
+                # a failed operation must not roll back the others in the batch
+                db_utils.execute_sql(conn, "SAVEPOINT writer_op")
+                try:
+                    result = getattr(store, "_" + op)(*args)
+                    db_utils.execute_sql(conn, "RELEASE writer_op")
+                except Exception as e:
+                    db_utils.execute_sql(conn, "ROLLBACK TO writer_op")
+                    db_utils.execute_sql(conn, "RELEASE writer_op")
+                    result = e
+                replies.append((worker_id, token, result))
+        for worker_id, token, result in replies:
+            responses[worker_id].put((token, result))
+        commits += 1
+        operations += len(replies)
+
+        now = time.time()
+        if now - last_report >= report_interval or not running:
+            total_commits += commits
+            total_operations += operations
+            print("[writer] %.1f commits/s, %.1f operations/commit (total: %d commits, %d operations)"
+                  % (commits / max(now - last_report, 1e-6), operations / max(commits, 1),
+                     total_commits, total_operations))
+            commits, operations = 0, 0
+            last_report = now
+
+    db_utils.flush_journal()
+    conn.close()